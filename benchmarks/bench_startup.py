@@ -0,0 +1,72 @@
+#!/usr/bin/python3
+"""
+**Startup time benchmark**
+
+Content
+#######
+Measures the startup cost of the two commandline apps in fresh interpreters:
+the plain import of the module and a full ``--version`` run. Each measurement is
+repeated and the median and minimum wall clock time are reported.
+
+Call it from the project folder:
+``python3 benchmarks/bench_startup.py --runs 20``
+
+Info
+####
+* **author:** (c) Thomas Lüth 2024
+* **email:** info@tlc-it-consulting.com
+* **created:** 2024-02-12
+
+Code
+####
+"""
+import os
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+
+PROJECT_PATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APPS=["cpm_downloader","cpm_dirlistcompare"]
+
+
+def measure(command, runs):
+    """Run the command several times and measure the wall clock time
+
+    Args:
+        command (list): Command and arguments
+        runs (int): Number of runs
+
+    Returns:
+        list: Seconds per run
+    """
+    timings=[]
+    for _ in range(runs):
+        start=time.perf_counter()
+        subprocess.run(command, cwd=PROJECT_PATH, capture_output=True, check=True)
+        timings.append(time.perf_counter()-start)
+    return timings
+
+
+def main():
+    '''
+    Main function executed when the python script will be called
+
+    '''
+    parser = argparse.ArgumentParser(description="Measures the startup time of the apps")
+    parser.add_argument('--runs', help="Number of runs per measurement", type=int, default=10)
+    options=parser.parse_args()
+    baseline=measure([sys.executable,"-c","pass"],options.runs)
+    print(f"{'measurement':40s} {'median ms':>10s} {'min ms':>10s}")
+    print(f"{'interpreter only':40s} {statistics.median(baseline)*1000:10.1f} "\
+        f"{min(baseline)*1000:10.1f}")
+    for app in APPS:
+        for label,command in ((f"import {app}",[sys.executable,"-c",f"import {app}"]),
+                              (f"{app} --version",[sys.executable,f"{app}.py","--version"])):
+            timings=measure(command,options.runs)
+            print(f"{label:40s} {statistics.median(timings)*1000:10.1f} "\
+                f"{min(timings)*1000:10.1f}")
+
+if __name__ == "__main__": # pragma: no cover
+    main()
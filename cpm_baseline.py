@@ -0,0 +1,146 @@
+"""
+**Baseline store for directory listings**
+
+Content
+#######
+Keeps the parsed directory listings of each machine as snapshots in a SQLite file.
+The entries of a snapshot are stored sorted by their key (``<Drive><User>_<file>``),
+so a new listing is compared against the latest snapshot of the machine with one
+merge walk over both sorted sequences, reporting added, removed and changed entries.
+All snapshots are kept, thus the progress can be queried later on.
+
+Info
+####
+* **author:** (c) Thomas Lüth 2024
+* **email:** info@tlc-it-consulting.com
+* **created:** 2024-02-16
+
+Code
+####
+"""
+import time
+import sqlite3
+import logging
+
+logger = logging.getLogger(__name__)
+
+SCHEMA=[
+    "CREATE TABLE IF NOT EXISTS snapshots (id INTEGER PRIMARY KEY, machine TEXT NOT NULL, "\
+        "created TEXT NOT NULL, source TEXT, entries INTEGER NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS snapshots_machine ON snapshots (machine, id)",
+    "CREATE TABLE IF NOT EXISTS entries (snapshot INTEGER NOT NULL, entry TEXT NOT NULL, "\
+        "size_k INTEGER, records INTEGER, attributes TEXT, PRIMARY KEY (snapshot, entry)) "\
+        "WITHOUT ROWID",
+]
+
+
+def diff_sorted(old_entries, new_entries):
+    """Merge walk over two sequences of entries sorted by their key
+
+    Args:
+        old_entries (iterable): Tuples (entry, size in k, records, attributes) of the baseline
+        new_entries (iterable): Tuples (entry, size in k, records, attributes) of the listing
+
+    Yields:
+        tuple: status (added, removed or changed), entry key
+    """
+    old_iter=iter(old_entries)
+    new_iter=iter(new_entries)
+    old=next(old_iter,None)
+    new=next(new_iter,None)
+    while old is not None or new is not None:
+        if new is None or (old is not None and old[0]<new[0]):
+            yield "removed",old[0]
+            old=next(old_iter,None)
+        elif old is None or new[0]<old[0]:
+            yield "added",new[0]
+            new=next(new_iter,None)
+        else:
+            if tuple(old[1:])!=tuple(new[1:]):
+                yield "changed",new[0]
+            old=next(old_iter,None)
+            new=next(new_iter,None)
+
+
+class BaselineStore():
+    """SQLite file with the snapshots of the directory listings per machine
+    """
+    def __init__(self, filename):
+        self.filename=filename
+        self._connection=sqlite3.connect(filename)
+        for statement in SCHEMA:
+            self._connection.execute(statement)
+
+    def latest(self, machine):
+        """Determine the latest snapshot of a machine
+
+        Args:
+            machine (str): Name of the machine
+
+        Returns:
+            int: id of the snapshot, None if there is none
+        """
+        row=self._connection.execute("SELECT MAX(id) FROM snapshots WHERE machine=?",
+                                     (machine,)).fetchone()
+        return row[0]
+
+    def entries(self, snapshot):
+        """Entries of a snapshot, sorted by key
+
+        Args:
+            snapshot (int): id of the snapshot, None for no snapshot
+
+        Returns:
+            iterable: Tuples (entry, size in k, records, attributes)
+        """
+        if snapshot is None:
+            return iter(())
+        return self._connection.execute("SELECT entry, size_k, records, attributes "\
+            "FROM entries WHERE snapshot=? ORDER BY entry",(snapshot,))
+
+    def store(self, machine, entries, source=None):
+        """Store the entries as new snapshot of the machine
+
+        Args:
+            machine (str): Name of the machine
+            entries (list): Tuples (entry, size in k, records, attributes)
+            source (str, optional): Where the entries came from, eg. the listing files
+
+        Returns:
+            int: id of the new snapshot
+        """
+        with self._connection:
+            cursor=self._connection.execute("INSERT INTO snapshots (machine, created, source, "\
+                "entries) VALUES (?,?,?,?)",
+                (machine,time.strftime("%Y-%m-%dT%H:%M:%S"),source,len(entries)))
+            snapshot=cursor.lastrowid
+            self._connection.executemany("INSERT INTO entries VALUES (?,?,?,?,?)",
+                                         ((snapshot,)+tuple(entry) for entry in entries))
+        logger.info("Snapshot %d of %s stored with %d entries",snapshot,machine,len(entries))
+        return snapshot
+
+    def history(self, machine=None):
+        """Snapshots stored so far
+
+        Args:
+            machine (str, optional): Only the snapshots of this machine
+
+        Returns:
+            list: Tuples (id, machine, created, source, entries)
+        """
+        if machine is None:
+            return self._connection.execute("SELECT id, machine, created, source, entries "\
+                "FROM snapshots ORDER BY id").fetchall()
+        return self._connection.execute("SELECT id, machine, created, source, entries "\
+            "FROM snapshots WHERE machine=? ORDER BY id",(machine,)).fetchall()
+
+    def close(self):
+        """Close the store
+        """
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
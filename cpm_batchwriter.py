@@ -0,0 +1,253 @@
+"""
+**Batched output of received files**
+
+Content
+#######
+Writing thousands of small files one by one costs a few metadata round trips each,
+which dominates on network mounted archive volumes. The batch writer
+
+* creates every folder once, folders known to exist are not checked again
+* writes the files right away, a batch ends after ``batch_size`` files,
+  ``batch_interval`` seconds or at the end of the session
+* optionally syncs the files and their folders to disk at the end of the batch. Off by
+  default, every sync costs a round trip per file, more than the unbatched writing.
+* optionally stages the files in a local folder first and moves the whole batch into
+  the output folders at its end. A file the staging folder can not be renamed into
+  its folder is copied to ``<name>.part`` next to its target and renamed, so there
+  never is a half written file under the final name.
+
+Info
+####
+* **author:** (c) Thomas Lüth 2024
+* **email:** info@tlc-it-consulting.com
+* **created:** 2024-03-18
+
+Code
+####
+"""
+import os
+import time
+import errno
+import shutil
+import logging
+import tempfile
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+#: Files written before the batch is synced
+BATCH_SIZE=64
+#: Seconds after which a batch is synced, even if it is not full
+BATCH_INTERVAL=5.0
+#: Buffersize for copying staged files
+COPY_BUFFER=1024*1024
+
+
+def fsync_path(path):
+    """Sync a file or folder given by name to disk
+
+    Args:
+        path (str): File or folder
+
+    Raises:
+        OSError: The sync failed
+    """
+    if os.path.isdir(path) and not hasattr(os,'O_DIRECTORY'):
+        #folders can not be opened for syncing on Windows
+        return
+    descriptor=os.open(path,os.O_RDONLY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+
+class BatchWriter():
+    """Writes the received files in batches
+    """
+    def __init__(self, batch_size=BATCH_SIZE, batch_interval=BATCH_INTERVAL, staging=None,
+                 sync=False):
+        """Prepare the writer
+
+        Args:
+            batch_size (int, optional): Files written before the batch is committed
+            batch_interval (float, optional): Seconds after which a batch is committed
+            staging (str, optional): Local folder the files are staged in, None writes
+                them into the output folders directly
+            sync (bool, optional): Sync the files and folders of a batch to disk
+
+        Raises:
+            OSError: The staging folder could not be created
+        """
+        self.batch_size=batch_size
+        self.batch_interval=batch_interval
+        self.sync=sync
+        self.staging=None
+        if staging:
+            Path(staging).mkdir(parents=True, exist_ok=True)
+            self.staging=tempfile.mkdtemp(prefix="cpm_",dir=staging)
+        self.known_dirs=set()
+        self.pending=[]
+        self.batches=0
+        self.committed=0
+        self.failed=0
+        self._staged=0
+        self._batch_start=None
+
+    def ensure_dir(self, folder):
+        """Create a folder unless it is known to exist
+
+        Args:
+            folder (str): Folder to be created
+
+        Raises:
+            OSError: The folder could not be created
+        """
+        if folder in self.known_dirs:
+            return
+        Path(folder).mkdir(parents=True, exist_ok=True)
+        self.known_dirs.add(folder)
+
+    def write(self, folder, name, data):
+        """Write a file as part of the current batch
+
+        Args:
+            folder (str): Output folder
+            name (str): Filename
+            data (bytes): Content of the file
+
+        Raises:
+            OSError: The file could not be written
+        """
+        target=os.path.join(folder,name)
+        if self.staging is None:
+            self.ensure_dir(folder)
+            #closed right away, a batch must not hold a descriptor per file
+            with open(target,'wb') as out_file:
+                out_file.write(data)
+            self.pending.append((target,None))
+        else:
+            self._staged+=1
+            staged=os.path.join(self.staging,f"{self._staged:06d}_{name}")
+            with open(staged,'wb') as staged_file:
+                staged_file.write(data)
+            self.pending.append((target,staged))
+        if self._batch_start is None:
+            self._batch_start=time.monotonic()
+        if len(self.pending)>=self.batch_size:
+            self.commit()
+        else:
+            self.commit_due()
+
+    def commit_due(self):
+        """Commit the batch if its interval has passed
+        """
+        if self._batch_start is not None and \
+            time.monotonic()-self._batch_start>=self.batch_interval:
+            self.commit()
+
+    def commit(self):
+        """End the batch: sync its files if asked to and, if staged, move them into the
+        output folders, files that failed are logged and counted
+
+        Returns:
+            int: Number of files committed
+        """
+        if not self.pending:
+            return 0
+        pending=self.pending
+        self.pending=[]
+        self._batch_start=None
+        if self.staging is not None:
+            done=self._move_staged(pending)
+        elif self.sync:
+            done=self._sync_files(pending)
+        else:
+            done=list(dict.fromkeys(target for target,_ in pending))
+        if self.sync:
+            for folder in {os.path.dirname(target) for target in done}:
+                try:
+                    fsync_path(folder)
+                except OSError as err:
+                    logger.warning("folder %s could not be synced: %s",folder,str(err))
+        self.batches+=1
+        self.committed+=len(done)
+        logger.debug("Batch %d committed: %d files",self.batches,len(done))
+        return len(done)
+
+    def _failed(self, target, err):
+        self.failed+=1
+        logger.exception("file %s could not be written: %s",target,str(err))
+
+    def _sync_files(self, pending):
+        done=[]
+        #a file received again within the batch is synced once
+        for target in dict.fromkeys(target for target,_ in pending):
+            try:
+                fsync_path(target)
+                done.append(target)
+            except OSError as err:
+                self._failed(target,err)
+        return done
+
+    def _move_staged(self, pending):
+        latest={}
+        for target,staged in pending:
+            if target in latest:
+                #received again within the batch, only the last one is moved
+                try:
+                    os.unlink(latest[target])
+                except OSError as err:
+                    self._failed(latest[target],err)
+            latest[target]=staged
+        parts=[]
+        done=[]
+        for target,staged in latest.items():
+            try:
+                self.ensure_dir(os.path.dirname(target))
+                try:
+                    os.replace(staged,target)
+                    if self.sync:
+                        fsync_path(target)
+                    done.append(target)
+                    continue
+                except OSError as err:
+                    if err.errno!=errno.EXDEV:
+                        raise
+                part=target+".part"
+                with open(staged,'rb') as staged_file, open(part,'wb') as part_file:
+                    shutil.copyfileobj(staged_file,part_file,COPY_BUFFER)
+                    if self.sync:
+                        part_file.flush()
+                        os.fsync(part_file.fileno())
+                parts.append((part,target,staged))
+            except OSError as err:
+                self._failed(target,err)
+        #all copies are on disk, now they get their final names
+        for part,target,staged in parts:
+            try:
+                os.replace(part,target)
+                os.unlink(staged)
+                done.append(target)
+            except OSError as err:
+                self._failed(target,err)
+        return done
+
+    def close(self):
+        """Commit the last batch and remove the staging folder, it is kept if files
+        could not be moved out of it
+        """
+        self.commit()
+        if self.staging is not None:
+            if os.listdir(self.staging):
+                logger.warning("Files not written are kept in %s",self.staging)
+            else:
+                os.rmdir(self.staging)
+        logger.info("%d files written in %d batches, %d failed",
+                    self.committed,self.batches,self.failed)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,216 @@
+"""
+**Capture and replay of raw serial streams**
+
+Content
+#######
+The capture recorder tees every byte read from the serial line into an append-only
+capture file. The replay reads such a capture file and offers the same ``read_until``
+interface as the serial line, so a recorded session can be processed again by the
+downloader without the hardware, either as fast as possible or paced at the baudrate.
+
+Whether the driver marked line errors (PARMRK) while recording is kept in the sidecar
+file ``<capture>.info``, the replay decodes the marks only if it says so. Captures
+without sidecar are replayed as raw bytes.
+
+Info
+####
+* **author:** (c) Thomas Lüth 2024
+* **email:** info@tlc-it-consulting.com
+* **created:** 2024-02-07
+
+Code
+####
+"""
+import os
+import time
+import logging
+from tlu_utils import lazy_import
+
+#: Imported on first use
+json=lazy_import('json')
+
+logger = logging.getLogger(__name__)
+
+#: Buffersize for reading and writing capture files
+CAPTURE_BUFFER=64*1024
+#: Bits on the line per byte (8N1 = start + 8 data + stop)
+BITS_PER_BYTE=10
+#: Suffix of the sidecar file describing a capture
+INFO_SUFFIX=".info"
+
+
+def capture_filename(directory):
+    """Determine a timestamped name for a new capture file
+
+    Args:
+        directory (str): Folder to store the capture in
+
+    Returns:
+        str: full path of the capture file, eg. <directory>/cpm_20240207_101500.cap
+    """
+    return os.path.join(directory,time.strftime("cpm_%Y%m%d_%H%M%S.cap"))
+
+
+def write_capture_info(filename, marked):
+    """Write the sidecar file describing how the capture was recorded
+
+    Args:
+        filename (str): Capture file
+        marked (bool): Bytes with line errors are marked (PARMRK) in the capture
+    """
+    with open(filename+INFO_SUFFIX,"w",encoding='utf-8') as info_file:
+        json.dump({"line_errors_marked":marked,
+                   "created":time.strftime("%Y-%m-%dT%H:%M:%S")},info_file)
+
+
+def capture_marked(filename):
+    """Determine whether line errors are marked in a capture
+
+    Args:
+        filename (str): Capture file
+
+    Returns:
+        bool: True if the sidecar file says so, False without or with an unreadable one
+    """
+    try:
+        with open(filename+INFO_SUFFIX,"r",encoding='utf-8') as info_file:
+            return json.load(info_file).get("line_errors_marked") is True
+    except (OSError, ValueError, AttributeError):
+        return False
+
+
+class CaptureRecorder():
+    """Wraps a serial line and appends every byte read into a capture file
+    """
+    def __init__(self, line, filename, marked=False):
+        """Open the capture file
+
+        Args:
+            line (serial.Serial): Serial line to be recorded
+            filename (str): Capture file, appended if it exists
+            marked (bool, optional): The driver marks bytes with line errors
+        """
+        self.line=line
+        self.filename=filename
+        self.recorded=0
+        self._file=open(filename,"ab",buffering=CAPTURE_BUFFER) #pylint: disable=consider-using-with
+        try:
+            write_capture_info(filename,marked)
+        except OSError:
+            self._file.close()
+            raise
+        logger.info("Recording serial stream to %s",filename)
+
+    def read_until(self, *args, **kwargs):
+        """Read from the line like serial.Serial.read_until and record the bytes
+
+        Returns:
+            bytes: Bytes read from the line
+        """
+        data=self.line.read_until(*args, **kwargs)
+        self._file.write(data)
+        self.recorded+=len(data)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.line, name)
+
+    def flush(self):
+        """Write the buffered bytes into the capture file
+        """
+        self._file.flush()
+
+    def close(self):
+        """Flush and close the capture file
+        """
+        self._file.close()
+        logger.info("%d Bytes recorded to %s",self.recorded,self.filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class CaptureReplay():
+    """Offers a recorded capture file like a serial line
+    """
+    def __init__(self, filename, baud=None):
+        """Open the capture
+
+        Args:
+            filename (str): Capture file to be replayed
+            baud (int, optional): Pace the replay at this baudrate, None as fast as possible
+        """
+        self.filename=filename
+        self.baud=baud
+        self.is_open=True
+        self.replayed=0
+        self.marked=capture_marked(filename)
+        self._buffer=bytearray()
+        self._eof=False
+        self._started=time.monotonic()
+        self._file=open(filename,"rb") #pylint: disable=consider-using-with
+        logger.info("Replaying capture %s %s%s",filename,
+                    f"at {baud} Baud" if baud else "at full speed",
+                    ", line errors marked" if self.marked else "")
+
+    def _fill(self):
+        chunk=self._file.read(CAPTURE_BUFFER)
+        if not chunk:
+            self._eof=True
+        self._buffer+=chunk
+
+    def _pace(self, count):
+        self.replayed+=count
+        if self.baud:
+            delay=self.replayed*BITS_PER_BYTE/self.baud-(time.monotonic()-self._started)
+            if delay>0:
+                time.sleep(delay)
+
+    def read_until(self, expected=b'\n', size=None):
+        """Read like serial.Serial.read_until: until expected is found, size is reached
+        or the capture ends.
+
+        Raises:
+            EOFError: The whole capture has been replayed
+
+        Returns:
+            bytes: Bytes of the capture
+        """
+        start=0
+        while True:
+            pos=self._buffer.find(expected,start)
+            if pos>=0:
+                end=pos+len(expected)
+                break
+            if size is not None and len(self._buffer)>=size:
+                end=size
+                break
+            if self._eof:
+                if not self._buffer:
+                    raise EOFError(f"end of capture {self.filename}")
+                end=len(self._buffer)
+                break
+            start=max(0,len(self._buffer)-len(expected)+1)
+            self._fill()
+        if size is not None:
+            end=min(end,size)
+        data=bytes(self._buffer[:end])
+        del self._buffer[:end]
+        self._pace(len(data))
+        return data
+
+    def close(self):
+        """Close the capture file
+        """
+        self.is_open=False
+        self._file.close()
+        logger.info("%d Bytes replayed from %s",self.replayed,self.filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,393 @@
+"""
+**Daemon mode of the downloader**
+
+Content
+#######
+In daemon mode the downloader keeps its serial ports open across transfer sessions.
+Every port is served by a worker thread, ``quit`` received on a port ends the session
+only and the next session starts right away on the open line, with the output path
+valid at that time.
+
+The daemon is controlled through a local Unix socket. Every line sent is a command,
+the answer is one line of JSON:
+
+* ``ports``: the ports served, their output path and state
+* ``stats [<device>]``: counters of the sessions so far and of the running session
+* ``path <device> <path>``: output path of the next sessions on the port
+* ``pause [<device>]`` / ``resume [<device>]``: stop and continue reading the port,
+  all ports without a device. While paused the line is not read, so RTS/CTS holds
+  the sender.
+* ``shutdown``: end all sessions and the daemon
+
+Info
+####
+* **author:** (c) Thomas Lüth 2024
+* **email:** info@tlc-it-consulting.com
+* **created:** 2024-03-04
+
+Code
+####
+"""
+import os
+import json
+import socket
+import logging
+import threading
+import socketserver
+from pathlib import Path
+from tlu_utils import lazy_import
+
+#: Imported on first use, cpm_downloader imports this module on demand as well
+serial=lazy_import('serial')
+playsound=lazy_import('playsound')
+signal=lazy_import('signal')
+cpm_downloader=lazy_import('cpm_downloader')
+cpm_dirlistcompare=lazy_import('cpm_dirlistcompare')
+cpm_batchwriter=lazy_import('cpm_batchwriter')
+
+logger = logging.getLogger(__name__)
+
+#: Seconds before a port that could not be opened or failed is opened again
+REOPEN_INTERVAL=10.0
+#: Seconds a paused read checks whether the port is stopped
+PAUSE_POLL=1.0
+
+
+class SessionGate():
+    """Wraps the serial line of a worker: reads block while the worker is paused and
+    raise EOFError once the worker is stopped, which ends the running session
+    """
+    def __init__(self, line, worker):
+        self.line=line
+        self.worker=worker
+
+    def read_until(self, *args, **kwargs):
+        """Read from the line like serial.Serial.read_until, unless paused or stopped
+
+        Raises:
+            EOFError: The worker is stopped
+
+        Returns:
+            bytes: Bytes read from the line
+        """
+        while not self.worker.resumed.wait(PAUSE_POLL):
+            if self.worker.stopping.is_set():
+                break
+        if self.worker.stopping.is_set():
+            raise EOFError(f"port {self.worker.device} stopped")
+        return self.line.read_until(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.line, name)
+
+
+class PortWorker(threading.Thread):
+    """Serves one serial port: keeps it open and runs one session after the other
+    """
+    #: Counters of the receiver summed up over the sessions
+    counters=("files","written","failed","quarantined","line_errors")
+
+    def __init__(self, device, file_path, baud, parity='N', read_timeout=None, #pylint: disable=too-many-arguments
+                 frame_timeout=None, line_errors=True, reference=None, sounds=(None,None),
+                 batch=None):
+        """Prepare the worker, the port is opened when the thread runs
+
+        Args:
+            device (str): Serial device
+            file_path (str): Output path of the sessions
+            baud (int): Baudrate of the line
+            parity (str, optional): Parity of the line, N, E or O
+            read_timeout (float, optional): Seconds a read may block
+            frame_timeout (float, optional): Seconds a frame may stall, None waits forever
+            line_errors (bool, optional): Detect parity and framing errors on the line
+            reference (iterable, optional): Entries already transferred
+            sounds (tuple, optional): Sounds played after a session and on errors
+            batch (dict, optional): Arguments of the BatchWriter used per session,
+                None writes the files one by one
+        """
+        super().__init__(name=f"port {device}", daemon=True)
+        self.device=device
+        self.file_path=file_path
+        self.baud=baud
+        self.parity=parity
+        self.read_timeout=read_timeout
+        self.frame_timeout=frame_timeout
+        self.line_errors=line_errors
+        self.reference=reference
+        self.ok_sound,self.fail_sound=sounds
+        self.batch=batch
+        self.state="closed"
+        self.sessions=0
+        self.totals=dict.fromkeys(self.counters,0)
+        self.receiver=None
+        self.resumed=threading.Event()
+        self.resumed.set()
+        self.stopping=threading.Event()
+        self._lock=threading.Lock()
+
+    def run(self):
+        """Open the port and run sessions until the worker is stopped,
+        a port that fails is opened again after REOPEN_INTERVAL
+        """
+        while not self.stopping.is_set():
+            try:
+                with serial.Serial(self.device, self.baud, rtscts=1, timeout=self.read_timeout,
+                                   parity=self.parity) as ser:
+                    error_marking=False
+                    if self.line_errors:
+                        error_marking=cpm_downloader.enable_error_marking(ser)
+                    self.state="open"
+                    logger.info("Port %s open, waiting for sessions",self.device)
+                    gate=SessionGate(ser,self)
+                    while not self.stopping.is_set():
+                        self.session(gate,error_marking)
+            except (ValueError, serial.SerialException, IOError) as err:
+                logger.exception("Port %s failed, cause: %s",self.device,str(err))
+                self.state="failed"
+                self.stopping.wait(REOPEN_INTERVAL)
+        self.state="stopped"
+        logger.info("Port %s closed after %d sessions",self.device,self.sessions)
+
+    def session(self, line, error_marking=False):
+        """Receive one session, ends on quit or when the worker is stopped
+
+        Args:
+            line (SessionGate): Line of the worker
+            error_marking (bool, optional): The driver marks bytes with line errors
+        """
+        receiver=cpm_downloader.Receiver(self.file_path,None,self.fail_sound,self.frame_timeout)
+        receiver.error_marking=error_marking
+        receiver.tracker=cpm_dirlistcompare.MissingTracker(self.reference)
+        if self.batch:
+            receiver.writer=cpm_batchwriter.BatchWriter(**self.batch)
+        self.receiver=receiver
+        try:
+            receiver.receive(line)
+        finally:
+            if receiver.writer is not None:
+                receiver.writer.close()
+        if not receiver.reader.frames:
+            return
+        with self._lock:
+            self.sessions+=1
+            for counter in self.counters:
+                self.totals[counter]+=getattr(receiver,counter)
+        logger.info("Session %d on %s ended: %d files, %d Bytes written to %s",
+                    self.sessions,self.device,receiver.files,receiver.written,self.file_path)
+        if not self.stopping.is_set():
+            playsound.playsound(self.ok_sound)
+
+    def set_path(self, file_path):
+        """Change the output path, valid from the next session on
+
+        Args:
+            file_path (str): New output path, created if missing
+
+        Raises:
+            OSError: The path could not be created
+        """
+        Path(file_path).mkdir(parents=True, exist_ok=True)
+        self.file_path=file_path
+        logger.info("Port %s stores the next sessions in %s",self.device,file_path)
+
+    def pause(self):
+        """Stop reading the port, the sender is held by the flow control
+        """
+        self.resumed.clear()
+        logger.info("Port %s paused",self.device)
+
+    def resume(self):
+        """Continue reading the port
+        """
+        self.resumed.set()
+        logger.info("Port %s resumed",self.device)
+
+    def stop(self):
+        """End the running session and close the port
+        """
+        self.stopping.set()
+        self.resumed.set()
+
+    def stats(self):
+        """Counters of the port
+
+        Returns:
+            dict: sessions and totals so far, the running session in key session
+        """
+        with self._lock:
+            stats={"device":self.device,"path":self.file_path,"state":self.status(),
+                   "sessions":self.sessions}
+            stats.update(self.totals)
+        receiver=self.receiver
+        if receiver is not None and receiver.reader is not None:
+            stats["session"]={"frames":receiver.reader.frames,
+                              "received":receiver.reader.received,
+                              "stalls":receiver.reader.stalls,
+                              "pending":receiver.reader.pending}
+            stats["session"].update((counter,getattr(receiver,counter))
+                                    for counter in self.counters)
+        return stats
+
+    def status(self):
+        """State of the port: closed, open, paused, failed or stopped
+
+        Returns:
+            str: state
+        """
+        if self.state=="open" and not self.resumed.is_set():
+            return "paused"
+        return self.state
+
+
+class ControlHandler(socketserver.StreamRequestHandler):
+    """Executes the commands sent to the control socket, one per line
+    """
+    def handle(self):
+        for line in self.rfile:
+            command=line.decode('utf-8','replace').strip()
+            if not command:
+                continue
+            answer=self.server.execute(command)
+            self.wfile.write(json.dumps(answer).encode('utf-8')+b'\n')
+            self.wfile.flush()
+
+
+class ControlServer(socketserver.ThreadingUnixStreamServer):
+    """Control socket of the daemon
+    """
+    daemon_threads=True
+
+    def __init__(self, socket_path, workers):
+        """Bind the control socket
+
+        Args:
+            socket_path (str): Path of the Unix socket
+            workers (list): PortWorker of the ports served
+        """
+        self.workers={worker.device: worker for worker in workers}
+        super().__init__(socket_path,ControlHandler)
+        os.chmod(socket_path,0o600)
+
+    def execute(self, command):
+        """Execute a control command
+
+        Args:
+            command (str): Command and its arguments separated by blanks
+
+        Returns:
+            dict: Answer, key ok tells whether the command succeeded
+        """
+        name,*args=command.split()
+        method=getattr(self,"cmd_"+name.lower(),None)
+        if method is None:
+            return {"ok":False,"error":f"unknown command {name}"}
+        try:
+            answer=method(*args)
+        except TypeError:
+            return {"ok":False,"error":f"wrong arguments for {name}"}
+        except (KeyError, OSError) as err:
+            return {"ok":False,"error":str(err)}
+        answer["ok"]=True
+        return answer
+
+    def select(self, device=None):
+        """Workers addressed by a command
+
+        Args:
+            device (str, optional): Device of the port, all ports if None
+
+        Raises:
+            KeyError: The device is not served
+
+        Returns:
+            list: PortWorker selected
+        """
+        if device is None:
+            return list(self.workers.values())
+        if device not in self.workers:
+            raise KeyError(f"unknown port {device}")
+        return [self.workers[device]]
+
+    def cmd_ports(self):
+        """Ports served"""
+        return {"ports":[{"device":worker.device,"path":worker.file_path,
+                          "state":worker.status()} for worker in self.workers.values()]}
+
+    def cmd_stats(self, device=None):
+        """Statistics of all ports or one port"""
+        return {"stats":[worker.stats() for worker in self.select(device)]}
+
+    def cmd_path(self, device, file_path):
+        """Change the output path of a port"""
+        self.select(device)[0].set_path(file_path)
+        return {"device":device,"path":file_path}
+
+    def cmd_pause(self, device=None):
+        """Pause all ports or one port"""
+        workers=self.select(device)
+        for worker in workers:
+            worker.pause()
+        return {"paused":[worker.device for worker in workers]}
+
+    def cmd_resume(self, device=None):
+        """Resume all ports or one port"""
+        workers=self.select(device)
+        for worker in workers:
+            worker.resume()
+        return {"resumed":[worker.device for worker in workers]}
+
+    def cmd_shutdown(self):
+        """Stop the daemon, serve_forever returns"""
+        threading.Thread(target=self.shutdown,daemon=True).start()
+        return {}
+
+
+def remove_stale_socket(socket_path):
+    """Remove a socket left over by a daemon not running any longer
+
+    Args:
+        socket_path (str): Path of the Unix socket
+
+    Raises:
+        OSError: A daemon is listening on the socket
+    """
+    if not os.path.exists(socket_path):
+        return
+    with socket.socket(socket.AF_UNIX,socket.SOCK_STREAM) as probe:
+        try:
+            probe.connect(socket_path)
+        except OSError:
+            os.unlink(socket_path)
+            return
+    raise OSError(f"daemon already listening on {socket_path}")
+
+
+def run_daemon(socket_path, workers):
+    """Serve the ports and the control socket until shutdown, SIGTERM or Ctrl-C
+
+    Args:
+        socket_path (str): Path of the Unix socket
+        workers (list): PortWorker of the ports to be served
+
+    Raises:
+        OSError: The control socket could not be bound
+    """
+    remove_stale_socket(socket_path)
+    server=ControlServer(socket_path,workers)
+    for worker in workers:
+        worker.start()
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM,lambda *args: server.cmd_shutdown())
+    logger.info("Daemon serving %d ports, control socket %s",len(workers),socket_path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Daemon interrupted")
+    finally:
+        server.server_close()
+        os.unlink(socket_path)
+        for worker in workers:
+            worker.stop()
+        for worker in workers:
+            worker.join()
+    logger.info("Daemon stopped")
@@ -29,14 +29,144 @@ Created on 19.01.2024
 @author: th.lueth@tlc-it-consulting.com
 '''
 import os
+import glob
 import logging
 import sys
 import re
-from tlu_utils import get_git_version,add_parser_log_args,cmdline_main,configure_logging
+from tlu_utils import get_git_version,add_parser_log_args,cmdline_main,configure_logging,\
+    lazy_import,span
+
+#: Imported on first use, a single file per side is parsed without process pool
+futures=lazy_import('concurrent.futures')
+json=lazy_import('json')
+csv=lazy_import('csv')
+sqlite3=lazy_import('sqlite3')
+cpm_baseline=lazy_import('cpm_baseline')
 
 
 logger = logging.getLogger(__name__)
 
+#: Drive and user areas not reported as missing
+EXCLUDED_AREAS=["F02","F04","F05","F06","F07","F08","F09","F11","F13","F14",
+                "F15","G07","G08","G09","G10","G11","H01","H03","H04","H07"]
+#: Extensions not reported as missing
+EXCLUDED_EXTENSIONS=["BAK","BAD","TRK","$$$","SEP"]
+#: Buffersize for writing results into a file
+OUTPUT_BUFFER=64*1024
+#: Total size of the listings from which --jobs 0 parses them in a process pool,
+#: starting the pool costs about as much as parsing half a MB
+POOL_MIN_BYTES=2*1024*1024
+
+
+def split_entry(entry):
+    """Split a dir-entry into its parts
+
+    Args:
+        entry (String): <Drive><User>_<filename>.<extension>, eg. F00_CCP.COM
+
+    Returns:
+        dict: entry, drive, user and file
+    """
+    return {"entry":entry,"drive":entry[0:1],"user":entry[1:3],"file":entry[4:]}
+
+
+class DiffWriter():
+    """Writes the differences as they are found, plain text for humans.
+    Subclasses write machine readable formats.
+    """
+    def __init__(self, stream):
+        self.stream=stream
+        self.count=0
+        self.areas={}
+
+    def start(self):
+        """Write anything needed before the first entry
+        """
+        print("\nResults:",file=self.stream)
+        print("========",file=self.stream)
+
+    def write(self, entry, status="missing"):
+        """Write one difference
+
+        Args:
+            entry (String): <Drive><User>_<filename>.<extension>
+            status (String): Kind of difference
+        """
+        self.count+=1
+        area=entry[0:3]
+        self.areas[area]=self.areas.get(area,0)+1
+        self.write_entry(entry,status)
+
+    def write_entry(self, entry, status): #pylint: disable=unused-argument
+        """Format one difference
+
+        Args:
+            entry (String): <Drive><User>_<filename>.<extension>
+            status (String): Kind of difference
+        """
+        self.stream.write(entry+"\n")
+
+    def close(self):
+        """Write anything needed after the last entry
+        """
+
+
+class JsonLinesWriter(DiffWriter):
+    """One JSON object per difference and line
+    """
+    def start(self):
+        pass
+
+    def write_entry(self, entry, status):
+        fields=split_entry(entry)
+        fields["status"]=status
+        self.stream.write(json.dumps(fields)+"\n")
+
+
+class CsvWriter(DiffWriter):
+    """Differences as CSV with header line
+    """
+    fieldnames=["entry","drive","user","file","status"]
+
+    def __init__(self, stream):
+        super().__init__(stream)
+        self._writer=None
+
+    def start(self):
+        self._writer=csv.DictWriter(self.stream,fieldnames=self.fieldnames)
+        self._writer.writeheader()
+
+    def write_entry(self, entry, status):
+        fields=split_entry(entry)
+        fields["status"]=status
+        self._writer.writerow(fields)
+
+
+class SummaryWriter(DiffWriter):
+    """Only one JSON object with the counts per drive and user at the end
+    """
+    def start(self):
+        pass
+
+    def write_entry(self, entry, status):
+        pass
+
+    def close(self):
+        drives={}
+        for area,count in sorted(self.areas.items()):
+            drives.setdefault(area[0:1],{})[area[1:3]]=count
+        json.dump({"total":self.count,"drives":drives},self.stream,indent=2)
+        self.stream.write("\n")
+
+
+#: Output formats, selectable via --format
+WRITERS={
+    "text": DiffWriter,
+    "jsonl": JsonLinesWriter,
+    "csv": CsvWriter,
+    "summary": SummaryWriter,
+}
+
 class DirFileState():
     """States for statemachine
     """
@@ -45,6 +175,152 @@ class DirFileState():
     def __str__(self):
         return self.action
 
+DirFileState.start=DirFileState("start")
+DirFileState.dirheader=DirFileState("header")
+DirFileState.dirlist=DirFileState("dirlist")
+
+
+class ListingParser():
+    """Statemachine extracting the dir-entries of a listing line by line,
+    the text may also be fed in chunks as it arrives, eg. from the serial line
+    """
+    dir_string_regex=re.compile(r"Directory For Drive (\S):  User \s+(\d)")
+    dir_list_start="------------ ------ ------"
+    # "ALLFILES LST     0k      0 Dir RW       CCP      COM     4k     25 Sys RW      "
+    # 1=fil, 2=filsub, 3=sizek, 4= blocks, 5=attrs (12 char)
+    dir_list_files_regex=re.compile(r"((\S+)\s+(\S+)\s+(\d+)k\s+(\d+) (.{12})\s*)")
+    empty_line_regex=re.compile(r"^\s*$")
+
+    def __init__(self):
+        self.state=DirFileState.start
+        self.drive=""
+        self.user=""
+        self.entries=[]
+        self._rest=""
+
+    def feed(self, text):
+        """Parse the complete lines of a chunk, the rest waits for the next chunk
+
+        Args:
+            text (String): next part of the listing
+
+        Returns:
+            list: Entries found in this chunk, see parse_line
+        """
+        lines=(self._rest+text).splitlines(keepends=True)
+        self._rest=lines.pop() if lines and not lines[-1].endswith("\n") else ""
+        found=len(self.entries)
+        for line in lines:
+            self.parse_line(line)
+        return self.entries[found:]
+
+    def close(self):
+        """Parse the last line if it had no line end
+
+        Returns:
+            list: Entries found in the last line
+        """
+        found=len(self.entries)
+        if self._rest:
+            self.parse_line(self._rest)
+            self._rest=""
+        return self.entries[found:]
+
+    def parse_line(self, line):
+        """Parse one line of the listing, entries found are added to entries as tuples
+        (<Drive><User>_<filename>, size in k, records, attributes)
+
+        Args:
+            line (String): line of the listing
+        """
+        if self.empty_line_regex.match(line):
+            #skip empty lines
+            return
+        if self.state==DirFileState.start:
+            matches=self.dir_string_regex.match(line)
+            if matches is None:
+                return #read next line
+            self.drive=matches.group(1)
+            self.user=f'{int(matches.group(2)):02d}'
+            self.state=DirFileState.dirheader
+            return
+        if self.state==DirFileState.dirheader:
+            if line.startswith(self.dir_list_start):
+                self.state=DirFileState.dirlist
+                return
+        if self.state==DirFileState.dirlist:
+            matches=self.dir_list_files_regex.findall(line)
+            if len(matches)==0:
+                #end of list reached
+                self.state=DirFileState.start
+                return
+            for ngroup in enumerate(matches):
+                dirfilename=self.drive+str(self.user)+"_"+\
+                    ngroup[1][1]+"."+ngroup[1][2]
+                self.entries.append((dirfilename,int(ngroup[1][3]),
+                                     int(ngroup[1][4]),ngroup[1][5].strip()))
+
+
+class MissingTracker():
+    """Keeps the set of entries still missing while a transfer runs: entries of the
+    listings fed, minus the ones of the reference and the files received so far
+    """
+    def __init__(self, reference=None):
+        """Prepare the tracker
+
+        Args:
+            reference (iterable, optional): entries already transferred, eg. from an archive
+        """
+        self.reference=set(reference or ())
+        self.received=set()
+        self.missing=set()
+        self.listed=0
+        self._parser=None
+
+    def start_listing(self):
+        """A new listing starts
+        """
+        self._parser=ListingParser()
+
+    def feed(self, data):
+        """Feed the next bytes of the listing
+
+        Args:
+            data (bytes): part of the listing as received
+        """
+        if self._parser is None:
+            self.start_listing()
+        with span("listing parse"):
+            self._add(self._parser.feed(data.decode('ascii','replace')))
+
+    def end_listing(self):
+        """The listing is complete
+
+        Returns:
+            int: Number of entries still missing
+        """
+        if self._parser is not None:
+            self._add(self._parser.close())
+            self._parser=None
+        return len(self.missing)
+
+    def _add(self, entries):
+        for entry in entries:
+            self.listed+=1
+            key=entry[0]
+            if key not in self.reference and key not in self.received and \
+                not Command.is_excluded(key):
+                self.missing.add(key)
+
+    def file_received(self, entry):
+        """A file has been received
+
+        Args:
+            entry (String): <Drive><User>_<filename>.<extension>
+        """
+        self.received.add(entry)
+        self.missing.discard(entry)
+
 class Command():
     """
     Commandline interface for the main app
@@ -59,13 +335,112 @@ class Command():
         :param parser: commandline parser
         '''
         add_parser_log_args(parser)
-        parser.add_argument('--file1', help="First file to compare", default="",
+        parser.add_argument('--file1', help="First file to compare, may also be a glob pattern "\
+                            "or a folder with *.lst files", default="",
+                            required=False, action='store')
+        parser.add_argument('--file2', help="Second file to compare, may also be a glob pattern "\
+                            "or a folder with *.lst files", default="",
+                            required=False, action='store')
+        parser.add_argument('--format', help="Output format of the results",
+                            choices=list(WRITERS), default="text",
                             required=False, action='store')
-        parser.add_argument('--file2', help="Second file to compare", default="",
+        parser.add_argument('--output', help="Write the results into this file instead of "\
+                            "the console", default="-", required=False, action='store')
+        parser.add_argument('--baseline', help="Compare --file1 against the latest snapshot "\
+                            "of the machine in this SQLite store and store it as new snapshot",
+                            default=None, required=False, action='store')
+        parser.add_argument('--machine', help="Name of the machine in the baseline store",
+                            default="default", required=False, action='store')
+        parser.add_argument('--keep_baseline', help="Do not store --file1 as new snapshot",
+                            required=False, action='store_true')
+        parser.add_argument('--history', help="List the snapshots of the machine in the "\
+                            "baseline store", required=False, action='store_true')
+        parser.add_argument('--jobs', help="Number of processes parsing the files, "\
+                            "0 = number of CPUs once the listings exceed 2 MB, one process "\
+                            "below", type=int, default=0,
                             required=False, action='store')
+
+    @staticmethod
+    def listing_files(pattern):
+        """Determine the listing files for a filename, glob pattern or folder
+
+        Args:
+            pattern (String): filename, glob pattern or folder, relative to the working directory
+
+        Returns:
+            list: Sorted filenames, the pattern itself if nothing matches
+        """
+        if os.path.isdir(pattern):
+            filenames=[os.path.join(pattern,name) for name in os.listdir(pattern)
+                       if name.lower().endswith(".lst")]
+        else:
+            filenames=glob.glob(pattern)
+        if len(filenames)==0:
+            #let the extraction report the missing file
+            return [pattern]
+        return sorted(filenames)
+
+    @staticmethod
+    def pool_size(jobs, filenames):
+        """Number of processes parsing the files
+
+        Args:
+            jobs (int): Number of processes, 0 = number of CPUs if the files together
+                reach POOL_MIN_BYTES, one process below
+            filenames (list): Files to be parsed
+
+        Returns:
+            int: Processes needed, below 2 the files are parsed without process pool
+        """
+        if jobs<1:
+            size=0
+            for filename in filenames:
+                try:
+                    size+=os.path.getsize(filename)
+                except OSError:
+                    #the extraction reports the file
+                    pass
+            jobs=(os.cpu_count() or 1) if size>=POOL_MIN_BYTES else 1
+        return min(jobs,len(filenames))
+
+    @staticmethod
+    def extract_files(filenames, jobs=0, details=False, executor=None):
+        """Extract and merge the dir-entries of several files, parsed concurrently
+
+        Args:
+            filenames (list): full filenames with path from files to analyze
+            jobs (int): Number of processes, 0 = see pool_size
+            details (bool): Return the entries with details like extract_entries
+            executor (ProcessPoolExecutor, optional): Process pool to be used,
+                None starts one if needed
+
+        Returns:
+            list: Merged list of filenames without duplicates, None if a file failed
+        """
+        extract=Command.extract_entries if details else Command.extract_file
+        jobs=Command.pool_size(jobs,filenames)
+        if jobs<2:
+            filelists=[extract(filename) for filename in filenames]
+        elif executor is None:
+            with futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+                return Command.extract_files(filenames,jobs,details,executor)
+        else:
+            #the spans timed inside the processes are lost, the parent times the whole
+            with span("listing parse"):
+                filelists=list(executor.map(extract,filenames,
+                                            chunksize=max(1,len(filenames)//(jobs*4))))
+        if any(filelist is None for filelist in filelists):
+            return None
+        merged={}
+        for filelist in filelists:
+            if details:
+                merged.update((entry[0],entry) for entry in filelist)
+            else:
+                merged.update(dict.fromkeys(filelist))
+        return list(merged.values()) if details else list(merged)
+
     @staticmethod
     def extract_file(filename, indicator=None):
-        #pylint: disable=too-many-locals,too-many-branches
         """Extract the dir-entries from given file
 
         Args:
@@ -75,59 +450,145 @@ class Command():
         Returns:
             list: List of filenames; <Drive><User>_<filename>_<Indicator for File>
         """
-        DirFileState.start=DirFileState("start")
-        dir_string_regex=re.compile(r"Directory For Drive (\S):  User \s+(\d)")
-        DirFileState.dirheader=DirFileState("header")
-        dir_list_start="------------ ------ ------"
-        DirFileState.dirlist=DirFileState("dirlist")
-        # "ALLFILES LST     0k      0 Dir RW       CCP      COM     4k     25 Sys RW      "
-        # 1=fil, 2=filsub, 3=sizek, 4= blocks, 5=attrs (12 char)
-        dir_list_files_regex=re.compile(r"((\S+)\s+(\S+)\s+(\d+)k\s+(\d+) (.{12})\s*)")
-        empty_line_regex=re.compile(r"^\s*$")
-        filelist=[]
-        drive=""
-        user=""
+        entries=Command.extract_entries(filename)
+        if entries is None:
+            return None
+        if indicator is None:
+            return [entry[0] for entry in entries]
+        return [entry[0]+"_"+indicator for entry in entries]
+
+    @staticmethod
+    def extract_entries(filename):
+        """Extract the dir-entries with their details from given file
+
+        Args:
+            filename (String): full filename with path from file to analyze
+
+        Returns:
+            list: List of tuples (<Drive><User>_<filename>, size in k, records, attributes)
+        """
+        parser=ListingParser()
         try:
-            state=DirFileState.start
-            with open(filename,"r",encoding='ascii') as f1:
+            with span("listing parse"), open(filename,"r",encoding='ascii') as f1:
                 while True:
                     line=f1.readline()
                     if len(line)==0:
                         #end of file indicator
                         break
-                    if empty_line_regex.match(line):
-                        #skip empty lines
-                        continue
-                    if state==DirFileState.start:
-                        matches=dir_string_regex.match(line)
-                        if matches is None:
-                            continue #read next line
-                        drive=matches.group(1)
-                        user=f'{int(matches.group(2)):02d}'
-                        state=DirFileState.dirheader
-                        continue
-                    if state==DirFileState.dirheader:
-                        if line.startswith(dir_list_start):
-                            state=DirFileState.dirlist
-                            continue
-                    if state==DirFileState.dirlist:
-                        matches=dir_list_files_regex.findall(line)
-                        if len(matches)==0:
-                            #end of list reached
-                            state=DirFileState.start
-                            continue
-                        for ngroup in enumerate(matches):
-                            dirfilename=drive+str(user)+"_"+\
-                                ngroup[1][1]+"."+ngroup[1][2]
-                            if indicator is not None:
-                                dirfilename=dirfilename+"_"+indicator
-                            filelist.append(dirfilename)
+                    parser.parse_line(line)
 
         except (OSError, IOError) as err:
             logger.exception("I am sorry to inform you that the file could not be opened,"+\
                 " cause: %s", str(err))
             return None
-        return filelist
+        return parser.entries
+
+    @staticmethod
+    def is_excluded(entry):
+        """Check if a dir-entry should not be reported
+
+        Args:
+            entry (String): <Drive><User>_<filename>.<extension>
+
+        Returns:
+            bool: True if the drive and user area or the extension is excluded
+        """
+        return entry[0:3] in EXCLUDED_AREAS or entry[-3:] in EXCLUDED_EXTENSIONS
+
+    @staticmethod
+    def compare_files(filename1, filename2, jobs):
+        """Compare the listings of two sides
+
+        Args:
+            filename1 (String): file, glob pattern or folder of the first side
+            filename2 (String): file, glob pattern or folder of the second side
+            jobs (int): Number of processes, 0 = see pool_size
+
+        Returns:
+            iterable: Tuples (status, entry) of the entries missing on the second side,
+                None if one of the files could not be read
+        """
+        files1=Command.listing_files(filename1)
+        files2=Command.listing_files(filename2)
+        logger.info("Comparing %d against %d listing files",len(files1),len(files2))
+        jobs=min(Command.pool_size(jobs,files1+files2),max(len(files1),len(files2)))
+        executor=None
+        if jobs>1:
+            #one pool serves both sides, its processes are started once
+            executor=futures.ProcessPoolExecutor(max_workers=jobs)
+        try:
+            filelist1=Command.extract_files(files1,jobs,executor=executor)
+            filelist2=Command.extract_files(files2,jobs,executor=executor)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        if (filelist1 is None) or (filelist2 is None):
+            return None
+        fileset2=set(filelist2)
+        #next check filelist2 for missing entries and report them
+        return (("missing",filename) for filename in filelist1
+                if filename not in fileset2 and not Command.is_excluded(filename))
+
+    @staticmethod
+    def compare_baseline(store, machine, filename1, jobs, keep_baseline=False):
+        """Compare listings against the latest snapshot of the machine and store them
+        as new snapshot
+
+        Args:
+            store (BaselineStore): Store with the snapshots
+            machine (String): Name of the machine
+            filename1 (String): file, glob pattern or folder of the listings
+            jobs (int): Number of processes, 0 = see pool_size
+            keep_baseline (bool): Do not store the listings as new snapshot
+
+        Returns:
+            iterable: Tuples (status, entry) with added, removed or changed entries,
+                None if one of the files could not be read
+        """
+        files1=Command.listing_files(filename1)
+        entries=Command.extract_files(files1,jobs,details=True)
+        if entries is None:
+            return None
+        entries.sort()
+        snapshot=store.latest(machine)
+        logger.info("Comparing %d listing files against snapshot %s of %s",
+                    len(files1),snapshot,machine)
+        #materialize before the new snapshot is stored
+        with span("diff"):
+            deltas=list(cpm_baseline.diff_sorted(store.entries(snapshot),entries))
+        if not keep_baseline:
+            store.store(machine,entries,filename1)
+        return deltas
+
+    @staticmethod
+    def write_results(results, output, output_format):
+        """Write the results while they are determined
+
+        Args:
+            results (iterable): Tuples (status, entry)
+            output (String): filename or - for the console
+            output_format (String): One of the WRITERS
+
+        Returns:
+            int: Number of results written, None if the output could not be opened
+        """
+        try:
+            stream=sys.stdout if output=="-" else \
+                open(output,"w",encoding='utf-8',newline='',buffering=OUTPUT_BUFFER) #pylint: disable=consider-using-with
+        except OSError as err:
+            logger.exception("output %s could not be opened: %s",output,str(err))
+            return None
+        try:
+            writer=WRITERS[output_format](stream)
+            writer.start()
+            with span("diff"):
+                for status,entry in results:
+                    writer.write(entry,status)
+            writer.close()
+        finally:
+            if stream is not sys.stdout:
+                stream.close()
+        return writer.count
 
     @staticmethod
     def handle(*args, **options):  #pylint: disable=unused-argument
@@ -141,40 +602,46 @@ class Command():
         log_level=options['loglevel']
         filename1=options['file1']
         filename2=options['file2']
-        if (len(filename1)<1 or len(filename2)<1):
+        baseline=options['baseline']
+        if baseline is None and (len(filename1)<1 or len(filename2)<1):
             logger.error("You have to provide the two filenames that should be compared,"\
                 " use --help for more info")
             return
+        if baseline is not None and len(filename1)<1 and not options['history']:
+            logger.error("You have to provide the file to be compared against the baseline,"\
+                " use --help for more info")
+            return
         current_path = os.path.dirname(os.path.abspath(sys.argv[0]))
         log_file=os.path.join(current_path,"log","cpm_downloader.log")
-        file1=os.path.join(current_path,filename1)
-        file2=os.path.join(current_path,filename2)
         use_logfile=options['use_logfile']
-        configure_logging(use_logfile,logging,log_file,log_level)
+        configure_logging(use_logfile,logging,log_file,log_level,options['log_queue'],
+                          options['log_repeat_interval'])
         logger.info("Starting the app now")
         if use_logfile:
             logger.info("Logging to %s at level: %s",str(log_file),str(log_level))
-        filelist1=Command.extract_file(file1)
-        filelist2=Command.extract_file(file2)
-        if (filelist1 is None) or (filelist2 is None):
+        if baseline is None:
+            results=Command.compare_files(filename1,filename2,options['jobs'])
+        else:
+            try:
+                store=cpm_baseline.BaselineStore(baseline)
+            except sqlite3.Error as err:
+                logger.exception("baseline %s could not be opened: %s",baseline,str(err))
+                return
+            with store:
+                if options['history']:
+                    for snapshot in store.history(options['machine']):
+                        print(";".join(str(column) for column in snapshot))
+                    return
+                results=Command.compare_baseline(store,options['machine'],filename1,
+                                                 options['jobs'],options['keep_baseline'])
+        if results is None:
             logger.error("There was a problem with one of the two files, app terminates.")
             return
-        targetlist=[]
-        #next check filelist2 for missing entries and report them
-        for filename in filelist1:
-            if filename not in filelist2:
-                if filename[0:3] not in ["F02","F04","F05","F06","F07","F08","F09","F11",
-                                         "F13","F14",
-                                        "F15","G07","G08","G09","G10","G11","H01","H03",
-                                        "H04","H07"] and \
-                    filename[-3:] not in ["BAK","BAD","TRK","$$$","SEP"]:
-                    targetlist.append(filename)
-
-        print("\nResults:")
-        print("========")
-        for name in targetlist:
-            print(name)
+        count=Command.write_results(results,options['output'],options['format'])
+        if count is not None:
+            logger.info("%d differences found",count)
         logger.info("Application terminated now")
+
 def main():
     '''
     Main function executed when the python script will be called
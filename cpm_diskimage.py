@@ -0,0 +1,248 @@
+"""
+**Disk image reassembly**
+
+Content
+#######
+Raw track dumps (``*.TRK`` files) received by the downloader are not stored as single
+files but written into one preallocated, memory-mapped disk image. The offset of a
+track is computed from the track number contained in the filename and the chosen
+geometry profile, so tracks may arrive out of order or be sent again after a failure.
+The tracks received completely are kept in the sidecar file ``<image>.info``, so an
+image reused for a retry reports only the tracks still missing. A short track is
+zero padded to its full size and stays missing until it is received completely.
+
+Geometry profiles are selected by name (see ``GEOMETRIES``) or given as a
+``<tracks>:<sectors>:<sectorsize>`` string, e.g. ``77:26:128``.
+
+Info
+####
+* **author:** (c) Thomas Lüth 2024
+* **email:** info@tlc-it-consulting.com
+* **created:** 2024-02-05
+
+Code
+####
+"""
+import os
+import re
+import mmap
+import logging
+from tlu_utils import lazy_import
+
+#: Imported on first use
+json=lazy_import('json')
+
+logger = logging.getLogger(__name__)
+
+#: Suffix of the sidecar file with the tracks received
+INFO_SUFFIX=".info"
+
+#: Filenames like t012.trk or g01_track7.trk, the last number is the track
+TRACK_NAME_REGEX=re.compile(r"^.*?(\d+)\D*\.trk$")
+
+
+class DiskGeometry():
+    """Geometry of a disk: number of tracks, sectors per track and bytes per sector
+    Tracks are counted linear, on double sided discs side 1 follows side 0.
+    """
+    def __init__(self, name, tracks, sectors, sector_size):
+        self.name=name
+        self.tracks=tracks
+        self.sectors=sectors
+        self.sector_size=sector_size
+
+    @property
+    def track_size(self):
+        """Number of bytes of one track"""
+        return self.sectors*self.sector_size
+
+    @property
+    def image_size(self):
+        """Number of bytes of the whole image"""
+        return self.tracks*self.track_size
+
+    def __str__(self):
+        return f"{self.name} ({self.tracks}x{self.sectors}x{self.sector_size})"
+
+
+#: Known geometry profiles, selectable via --geometry
+GEOMETRIES={
+    "8sssd": DiskGeometry("8sssd", 77, 26, 128),
+    "5dsdd": DiskGeometry("5dsdd", 160, 5, 1024),
+    "3dsdd": DiskGeometry("3dsdd", 160, 9, 512),
+}
+
+
+def parse_geometry(spec):
+    """Determine the geometry for a profile name or a <tracks>:<sectors>:<sectorsize> spec
+
+    Args:
+        spec (str): Profile name or geometry spec
+
+    Raises:
+        ValueError: spec is neither a known profile nor a valid geometry
+
+    Returns:
+        DiskGeometry: Geometry to be used for the image
+    """
+    if spec in GEOMETRIES:
+        return GEOMETRIES[spec]
+    parts=spec.split(":")
+    if len(parts)!=3:
+        raise ValueError(f"Unknown geometry {spec}, use one of "+\
+            ", ".join(GEOMETRIES)+" or <tracks>:<sectors>:<sectorsize>")
+    tracks,sectors,sector_size=(int(part) for part in parts)
+    if min(tracks,sectors,sector_size)<1:
+        raise ValueError(f"Invalid geometry {spec}, all values have to be positive")
+    return DiskGeometry(spec,tracks,sectors,sector_size)
+
+
+def track_number(filename):
+    """Extract the track number from a track dump filename
+
+    Args:
+        filename (str): lowercase filename as received, eg. t012.trk
+
+    Returns:
+        int: Track number or None if the name is no track dump
+    """
+    matches=TRACK_NAME_REGEX.match(filename)
+    if matches is None:
+        return None
+    return int(matches.group(1))
+
+
+class DiskImage():
+    """Image file that receives the track dumps at their computed offset
+    """
+    def __init__(self, filename, geometry):
+        """Open an existing image or create a new, preallocated one
+
+        Args:
+            filename (str): Image file
+            geometry (DiskGeometry): Geometry of the disk
+
+        Raises:
+            ValueError: An existing file does not match the geometry, it is left untouched
+            OSError: The image could not be opened or created
+        """
+        self.filename=filename
+        self.geometry=geometry
+        self.received=set()
+        self.short=set()
+        self.retried=0
+        size=os.path.getsize(filename) if os.path.exists(filename) else 0
+        exists=size>0
+        if exists and size!=geometry.image_size:
+            raise ValueError(f"{filename} has {size} Bytes, geometry {geometry} needs "\
+                f"{geometry.image_size}, wrong file or geometry?")
+        self._file=open(filename,"r+b" if exists else "w+b") #pylint: disable=consider-using-with
+        try:
+            if not exists:
+                self._file.truncate(geometry.image_size)
+                if hasattr(os,"posix_fallocate"):
+                    os.posix_fallocate(self._file.fileno(),0,geometry.image_size)
+            self._map=mmap.mmap(self._file.fileno(),geometry.image_size)
+        except (OSError, ValueError):
+            self._file.close()
+            raise
+        if exists:
+            self.received=self._load_info()
+        logger.info("%s image %s with geometry %s, %d tracks received before",
+                    "Reusing" if exists else "Created", filename, geometry, len(self.received))
+
+    def _load_info(self):
+        try:
+            with open(self.filename+INFO_SUFFIX,"r",encoding='utf-8') as info_file:
+                info=json.load(info_file)
+            if info["geometry"]!=str(self.geometry):
+                logger.warning("Image %s was written with geometry %s, tracks received "\
+                    "before are unknown",self.filename,info["geometry"])
+                return set()
+            return {track for track in info["received"] if 0<=track<self.geometry.tracks}
+        except FileNotFoundError:
+            return set()
+        except (OSError, ValueError, KeyError, TypeError) as err:
+            logger.warning("Info of image %s could not be read: %s",self.filename,str(err))
+            return set()
+
+    def _write_info(self):
+        #written next to the image and renamed, an interrupted write keeps the old one
+        info_name=self.filename+INFO_SUFFIX
+        with open(info_name+".tmp","w",encoding='utf-8') as info_file:
+            json.dump({"geometry":str(self.geometry),"received":sorted(self.received)},
+                      info_file)
+        os.replace(info_name+".tmp",info_name)
+
+    def write_track(self, track, data):
+        """Write the data of one track into the image
+
+        Args:
+            track (int): Track number
+            data (bytes): Track content, should match the track size
+
+        Returns:
+            bool: True if the track could be placed into the image
+        """
+        if not 0<=track<self.geometry.tracks:
+            logger.error("Track %d is outside of geometry %s, discarded",track,self.geometry)
+            return False
+        track_size=self.geometry.track_size
+        if track in self.received or track in self.short:
+            self.retried+=1
+            logger.info("Track %d received again, replaced",track)
+        offset=track*track_size
+        if len(data)<track_size:
+            logger.warning("Track %d has %d bytes instead of %d, kept as missing",
+                           track,len(data),track_size)
+            #no bytes of an earlier attempt remain behind the short data
+            data=data+bytes(track_size-len(data))
+            self.received.discard(track)
+            self.short.add(track)
+        else:
+            if len(data)>track_size:
+                logger.warning("Track %d has %d bytes instead of %d",track,len(data),track_size)
+                data=data[:track_size]
+            self.short.discard(track)
+            self.received.add(track)
+        self._map[offset:offset+track_size]=data
+        return True
+
+    def missing_tracks(self):
+        """Tracks not received completely so far
+
+        Returns:
+            list: Sorted list of missing track numbers
+        """
+        return [track for track in range(self.geometry.tracks) if track not in self.received]
+
+    def flush(self):
+        """Write the tracks received so far and the info file to disk
+        """
+        self._map.flush()
+        try:
+            self._write_info()
+        except OSError as err:
+            logger.warning("Info of image %s could not be written: %s",self.filename,str(err))
+
+    def close(self):
+        """Flush the image to disk and report missing tracks
+
+        Returns:
+            list: Sorted list of missing track numbers
+        """
+        missing=self.missing_tracks()
+        try:
+            self.flush()
+        finally:
+            self._map.close()
+            self._file.close()
+        logger.info("Image %s closed: %d of %d tracks received, %d retried",self.filename,
+                    len(self.received),self.geometry.tracks,self.retried)
+        if self.short:
+            logger.warning("Image %s has short tracks: %s",self.filename,
+                           ",".join(str(track) for track in sorted(self.short)))
+        if missing:
+            logger.warning("Image %s is missing tracks: %s",self.filename,
+                           ",".join(str(track) for track in missing))
+        return missing
@@ -12,15 +12,427 @@ Created on 12.01.2024
 @author: th.lueth@tlc-it-consulting.com
 '''
 import os
+import re
 import sys
+import time
 import logging
 from pathlib import Path
-import serial
-import playsound
-from tlu_utils import get_git_version,add_parser_log_args,cmdline_main,configure_logging
+try:
+    import termios
+except ImportError: # pragma: no cover
+    termios=None
+from tlu_utils import get_git_version,add_parser_log_args,cmdline_main,configure_logging,\
+    lazy_import,span
+from cpm_diskimage import DiskImage,parse_geometry,track_number
+from cpm_capture import CaptureRecorder,CaptureReplay,capture_filename,BITS_PER_BYTE
+
+#: Imported on first use, not needed for --version or --help
+serial=lazy_import('serial')
+playsound=lazy_import('playsound')
+json=lazy_import('json')
+cpm_dirlistcompare=lazy_import('cpm_dirlistcompare')
+cpm_daemon=lazy_import('cpm_daemon')
+cpm_batchwriter=lazy_import('cpm_batchwriter')
 
 logger = logging.getLogger(__name__)
 
+#: Subfolders named like CP/M drive and user area, eg. G01
+AREA_REGEX=re.compile(r"^[a-p]\d\d$")
+
+
+def line_timeouts(baud, read_timeout=None, frame_timeout=None):
+    """Determine the timeouts for the receive loop derived from the baudrate
+
+    Args:
+        baud (int): Baudrate of the line
+        read_timeout (float, optional): Seconds a read may block, derived if None
+        frame_timeout (float, optional): Seconds without a byte before a partially
+            received frame is considered stalled, derived if None, 0 disables
+
+    Returns:
+        tuple: read_timeout, frame_timeout in seconds
+    """
+    char_time=BITS_PER_BYTE/baud
+    if read_timeout is None:
+        read_timeout=max(0.5,32*char_time)
+    if frame_timeout is None:
+        frame_timeout=max(60.0,4096*char_time)
+    return read_timeout,frame_timeout
+
+
+class FrameTimeout(Exception):
+    """No byte arrived within the frame timeout while a frame was partially received
+    """
+    def __init__(self, partial):
+        super().__init__(f"Frame stalled after {len(partial)} Bytes")
+        self.partial=partial
+
+
+class FrameReader():
+    """
+    Reads the frames separated by STOP and GO from a line opened with a read timeout.
+    Reads return on time, so housekeeping is done while the line is idle and stalled
+    frames are detected instead of blocking forever.
+
+    """
+    def __init__(self, line, frame_timeout=None, housekeeping=None, housekeeping_interval=60.0):
+        """Prepare the reader
+
+        Args:
+            line (serial.Serial): Serial line or any other source offering read_until
+            frame_timeout (float, optional): Seconds without a byte before a partial frame
+                is given up, None or 0 waits forever
+            housekeeping (function, optional): Called periodically while reading
+            housekeeping_interval (float, optional): Seconds between housekeeping calls
+        """
+        self.line=line
+        self.frame_timeout=frame_timeout
+        self.housekeeping=housekeeping
+        self.housekeeping_interval=housekeeping_interval
+        self.frames=0
+        self.received=0
+        self.stalls=0
+        self.longest_gap=0.0
+        self._buffer=bytearray()
+        self._last_housekeeping=time.monotonic()
+
+    @property
+    def pending(self):
+        """Number of bytes received but not yet returned as frame"""
+        return len(self._buffer)
+
+    def read_frame(self, separator, sink=None):
+        """Read the next frame up to the separator
+
+        Args:
+            separator (bytes): Separator terminating the frame
+            sink (function, optional): Gets the bytes of the frame while they arrive
+
+        Raises:
+            FrameTimeout: The line stalled in the middle of the frame
+            EOFError: The source has no more data
+
+        Returns:
+            bytes: Frame without separator
+        """
+        start=0
+        fed=0
+        last_data=time.monotonic()
+        while True:
+            with span("marker search"):
+                pos=self._buffer.find(separator,start)
+            if pos>=0:
+                frame=bytes(self._buffer[:pos])
+                del self._buffer[:pos+len(separator)]
+                self.frames+=1
+                if sink is not None:
+                    sink(frame[fed:])
+                return frame
+            start=max(0,len(self._buffer)-len(separator)+1)
+            if sink is not None and start>fed:
+                #bytes in front of start can not be part of the separator
+                sink(bytes(self._buffer[fed:start]))
+                fed=start
+            with span("serial read"):
+                data=self.line.read_until(separator)
+            now=time.monotonic()
+            if data:
+                if self._buffer:
+                    self.longest_gap=max(self.longest_gap,now-last_data)
+                last_data=now
+                self.received+=len(data)
+                self._buffer+=data
+            elif self._buffer and self.frame_timeout and now-last_data>=self.frame_timeout:
+                partial=bytes(self._buffer)
+                self._buffer.clear()
+                self.stalls+=1
+                raise FrameTimeout(partial)
+            if self.housekeeping is not None and \
+                now-self._last_housekeeping>=self.housekeeping_interval:
+                self._last_housekeeping=now
+                self.housekeeping()
+
+
+def enable_error_marking(ser):
+    """Let the driver mark bytes received with parity or framing errors and breaks
+    in the stream (PARMRK) instead of passing or dropping them silently.
+
+    Args:
+        ser (serial.Serial): Opened serial line
+
+    Returns:
+        bool: True if the marking could be enabled, False if not supported
+    """
+    if termios is None or not hasattr(termios,'PARMRK'):
+        return False
+    try:
+        attrs=termios.tcgetattr(ser.fileno())
+        attrs[0]|=termios.INPCK|termios.PARMRK
+        attrs[0]&=~(termios.IGNPAR|termios.ISTRIP|termios.IGNBRK|termios.BRKINT)
+        termios.tcsetattr(ser.fileno(),termios.TCSANOW,attrs)
+    except (termios.error, OSError, ValueError, TypeError) as err:
+        logger.warning("Line error detection not available: %s",str(err))
+        return False
+    return True
+
+
+def decode_line_errors(data):
+    """Remove the error marks of a PARMRK stream
+
+    0xff 0xff is an escaped 0xff, 0xff 0x00 <byte> a byte received with a
+    parity or framing error and 0xff 0x00 0x00 a break condition.
+
+    Args:
+        data (bytes): Bytes read from a line with error marking enabled
+
+    Returns:
+        tuple: bytes without marks, number of line errors
+    """
+    pos=data.find(b'\xff')
+    if pos<0:
+        return data,0
+    errors=0
+    decoded=bytearray()
+    start=0
+    while pos>=0:
+        decoded+=data[start:pos]
+        marker=data[pos+1:pos+2]
+        if marker==b'\xff':
+            decoded+=marker
+            start=pos+2
+        elif marker==b'\x00' and pos+2<len(data):
+            errors+=1
+            if data[pos+2]!=0:
+                decoded+=data[pos+2:pos+3]
+            start=pos+3
+        else:
+            #incomplete mark at the end of the frame
+            errors+=1
+            start=len(data)
+        pos=data.find(b'\xff',start)
+    decoded+=data[start:]
+    return bytes(decoded),errors
+
+
+class Receiver():
+    """
+    Processes the frames read from a line: stores files, changes folders and quits.
+    Files received with line errors or that could not be written do not end the
+    session, suspect files are moved into the quarantine folder with a report.
+
+    """
+    stop_sep=b'>>>+++STOP+++<<<'
+    go_sep=b'<<<+++GO+++>>>'
+    quit_cmd='quit'
+    subfolder_cmd='#_'
+    listing_cmd='#!dir'
+    quarantine_folder='_quarantine'
+    #: Seconds between the housekeeping calls while the line is read
+    housekeeping_interval=60.0
+
+    def __init__(self, file_path, image=None, fail_sound=None, frame_timeout=None):
+        """Prepare the receiver
+
+        Args:
+            file_path (str): Output path, subfolders will be created below
+            image (DiskImage, optional): Image receiving the track dumps
+            fail_sound (str, optional): Sound to be played on errors
+            frame_timeout (float, optional): Seconds a frame may stall, None waits forever
+        """
+        self.file_path=file_path
+        self.subfolder=file_path
+        self.image=image
+        self.fail_sound=fail_sound
+        self.frame_timeout=frame_timeout
+        self.error_marking=False
+        self.tracker=None
+        self.listing_next=False
+        self.area=None
+        self.line_errors=0
+        self.failed=0
+        self.quarantined=0
+        self.files=0
+        self.written=0
+        self.reader=None
+        self.writer=None
+        self.housekeeping_tasks=[]
+
+    def housekeeping(self):
+        """Periodic work while the line is read, eg. flushing captures
+        """
+        for task in self.housekeeping_tasks:
+            task()
+        if self.writer is not None:
+            self.writer.commit_due()
+
+    def receive(self, line):
+        """Read and process frames until quit has been received
+
+        Args:
+            line (serial.Serial): Serial line or any other source offering read_until
+        """
+        interval=self.housekeeping_interval
+        if self.writer is not None:
+            #a batch is due at the latest half an interval after its batch_interval
+            interval=min(interval,self.writer.batch_interval/2)
+        reader=FrameReader(line,self.frame_timeout,self.housekeeping,interval)
+        self.reader=reader
+        stalled=False
+        while True:
+            ser_content=None
+            streamed=self.listing_next and self.tracker is not None
+            self.listing_next=False
+            try:
+                if streamed:
+                    self.tracker.start_listing()
+                ser_content=reader.read_frame(self.stop_sep,
+                                              self.tracker.feed if streamed else None)
+                if streamed:
+                    self.listing_done()
+                ser_filename=reader.read_frame(self.go_sep)
+            except EOFError:
+                if reader.pending or ser_content is not None:
+                    logger.warning("Incomplete frame at end of stream discarded")
+                logger.info("End of stream reached without quit")
+                break
+            except FrameTimeout as err:
+                partial=err.partial if ser_content is None else \
+                    ser_content+self.stop_sep+err.partial
+                self.quarantine("partial.bin",partial,str(err))
+                #a sender resuming delivers the rest of the stalled frame next
+                stalled=True
+                continue
+            errors=0
+            if self.error_marking:
+                ser_content,errors=decode_line_errors(ser_content)
+                ser_filename,name_errors=decode_line_errors(ser_filename)
+                errors+=name_errors
+            try:
+                ser_filename=ser_filename.decode('ascii').lower().strip()
+            except UnicodeDecodeError:
+                ser_filename=ser_filename.decode('ascii','replace').lower().strip()
+                errors+=1
+            if ser_filename == self.quit_cmd:
+                break
+            if stalled and (ser_content or not ser_filename.startswith("#")):
+                stalled=False
+                self.line_errors+=errors
+                self.quarantine(ser_filename,ser_content,
+                                f"frame {ser_filename} follows a stall",errors)
+                continue
+            stalled=False
+            self.process(ser_content,ser_filename,errors,streamed)
+        if self.writer is not None:
+            #the end of the session is a batch boundary
+            self.writer.commit()
+            self.failed+=self.writer.failed
+        logger.info("Line statistics: %d frames, %d Bytes, %d stalls, "\
+            "longest pause inside a frame %.1fs",
+            reader.frames,reader.received,reader.stalls,reader.longest_gap)
+        if self.tracker is not None and self.tracker.listed:
+            logger.info("%d files still missing: %s",len(self.tracker.missing),
+                        " ".join(sorted(self.tracker.missing)))
+        if self.line_errors or self.failed or self.quarantined:
+            logger.warning("Session had %d line errors, %d files not written, "\
+                "%d frames quarantined",self.line_errors,self.failed,self.quarantined)
+
+    def quarantine(self, name, data, reason, errors=0):
+        """Store the bytes of a frame that could not be processed for later analysis,
+        together with a report as sidecar file <name>.report
+
+        Args:
+            name (str): Filename received for the data
+            data (bytes): Bytes received
+            reason (str): Why the data is quarantined
+            errors (int, optional): Number of line errors in the frame
+        """
+        folder=os.path.join(self.file_path,self.quarantine_folder)
+        self.quarantined+=1
+        quarantine_path=os.path.join(folder,time.strftime("%Y%m%d_%H%M%S_")+\
+            f"{self.quarantined:03d}_"+os.path.basename(name))
+        report={"file":name,"folder":self.subfolder,"bytes":len(data),
+                "line_errors":errors,"reason":reason,
+                "received":time.strftime("%Y-%m-%dT%H:%M:%S")}
+        try:
+            Path(folder).mkdir(parents=True, exist_ok=True)
+            with open(quarantine_path,'wb') as bin_file:
+                bin_file.write(data)
+            with open(quarantine_path+".report",'w',encoding='utf-8') as report_file:
+                json.dump(report,report_file,indent=2)
+        except (IOError, OSError) as ferr:
+            logger.exception("quarantine %s could not be written: %s",quarantine_path,str(ferr))
+            return
+        logger.warning("%s, %d Bytes quarantined to %s",reason,len(data),quarantine_path)
+
+    def listing_done(self):
+        """A directory listing has been parsed, report the files still missing
+        """
+        missing=self.tracker.end_listing()
+        logger.info("Listing with %d entries parsed, %d files still missing",
+                    self.tracker.listed,missing)
+
+    def process(self, ser_content, ser_filename, errors=0, streamed=False):
+        """Process one frame
+
+        Args:
+            ser_content (bytes): Bytes received in front of the STOP separator
+            ser_filename (str): Command or filename received between STOP and GO
+            errors (int, optional): Number of line errors detected in the frame
+            streamed (bool, optional): The content has already been parsed as listing
+        """
+        if errors:
+            self.line_errors+=errors
+            self.quarantine(ser_filename,ser_content,
+                            f"{errors} line errors in frame {ser_filename}",errors)
+            playsound.playsound(self.fail_sound)
+            return
+        if ser_filename[0:2] == self.subfolder_cmd:
+            subfoldername=ser_filename[2:].strip()
+            self.subfolder=os.path.join(self.file_path,subfoldername)
+            if self.writer is not None:
+                self.writer.ensure_dir(self.subfolder)
+            else:
+                Path(self.subfolder).mkdir(parents=True, exist_ok=True)
+            logger.info("Path has been set to %s",self.subfolder)
+            self.area=subfoldername.upper() if AREA_REGEX.match(subfoldername) else None
+            return
+        if ser_filename == self.listing_cmd:
+            self.listing_next=True
+            logger.info("Next file is a directory listing")
+            return
+        if self.tracker is not None and not streamed and ser_filename.endswith(".lst"):
+            self.tracker.start_listing()
+            self.tracker.feed(ser_content)
+            self.listing_done()
+        track=track_number(ser_filename) if self.image is not None else None
+        if track is not None:
+            self.image.write_track(track,ser_content)
+            return
+        try:
+            ser_path=os.path.join(self.subfolder,ser_filename)
+            with span("file write"):
+                if self.writer is not None:
+                    self.writer.write(self.subfolder,ser_filename,ser_content)
+                else:
+                    with open(ser_path,'wb') as bin_file:
+                        bin_file.write(ser_content)
+            self.files+=1
+            self.written+=len(ser_content)
+            logger.info("%d Bytes now written to: %s onfolder %s",
+                        len(ser_content),ser_filename,self.subfolder)
+            if self.tracker is not None and self.area is not None:
+                self.tracker.file_received(self.area+"_"+ser_filename.upper())
+                if self.tracker.listed:
+                    logger.info("%d files still missing",len(self.tracker.missing))
+            #playsound.playsound(ok_sound)
+
+        except (IOError, OSError, TypeError) as ferr:
+            self.failed+=1
+            logger.exception("file %s could not be written: %s",ser_path,str(ferr))
+            #the bytes received survive for a later analysis
+            self.quarantine(ser_filename,ser_content,f"could not be written: {ferr}")
+            playsound.playsound(self.fail_sound)
+
 
 class Command():
     """
@@ -39,10 +451,51 @@ class Command():
         parser.add_argument('--baud', help="Set the baudrate", type=int,
                             choices=[300,600,1200,2400,4800,9600,19200],
                             required=False, action='store', default=19200)
+        parser.add_argument('--parity', help="Parity of the line", choices=['N','E','O'],
+                            required=False, action='store', default='N')
+        parser.add_argument('--no_line_errors', help="Do not detect parity and framing errors "\
+                            "(driver marks) on the line or in a replayed capture",
+                            required=False, action='store_true')
         parser.add_argument('--device', help="Serial device", default="/dev/cu.usbserial-143230",
                             required=False, action='store')
         parser.add_argument('--path', help="Output path", default=".",
                             required=False, action='store')
+        parser.add_argument('--image', help="Assemble received *.trk files into this disk image",
+                            default=None, required=False, action='store')
+        parser.add_argument('--record', help="Record the raw serial stream into a "\
+                            "timestamped capture file in this folder",
+                            default=None, required=False, action='store')
+        parser.add_argument('--replay', help="Process this capture file instead of the serial line",
+                            default=None, required=False, action='store')
+        parser.add_argument('--replay_paced', help="Replay at the pace of --baud instead of "\
+                            "full speed", required=False, action='store_true')
+        parser.add_argument('--read_timeout', help="Seconds a read may block before "\
+                            "housekeeping is done, derived from the baudrate if not given",
+                            type=float, default=None, required=False, action='store')
+        parser.add_argument('--frame_timeout', help="Seconds without a byte before a partial "\
+                            "frame is quarantined, derived from the baudrate if not given, "\
+                            "0 waits forever", type=float, default=None, required=False,
+                            action='store')
+        parser.add_argument('--reference', help="Listings (file, glob pattern or folder) of "\
+                            "the files already transferred, received listings are compared "\
+                            "against them", default=None, required=False, action='store')
+        parser.add_argument('--geometry', help="Geometry profile of the disk image, "\
+                            "8sssd, 5dsdd, 3dsdd or <tracks>:<sectors>:<sectorsize>",
+                            default="8sssd", required=False, action='store')
+        parser.add_argument('--batch', help="Write the files in batches of this size, "\
+                            "folders are created once, 0 writes them one by one",
+                            type=int, default=0, required=False, action='store')
+        parser.add_argument('--batch_interval', help="Seconds after which a batch ends "\
+                            "even if it is not full", type=float, default=5.0, required=False,
+                            action='store')
+        parser.add_argument('--batch_sync', help="Sync the files and folders of each batch "\
+                            "to disk at its end", required=False, action='store_true')
+        parser.add_argument('--staging', help="Stage the files in this local folder and move "\
+                            "each batch into the output path at once, implies --batch",
+                            default=None, required=False, action='store')
+        parser.add_argument('--daemon', help="Keep running and serve all --device ports "\
+                            "(comma separated), controlled via this Unix socket",
+                            default=None, required=False, action='store')
 
 
     @staticmethod
@@ -69,65 +522,171 @@ class Command():
             return
 
         current_path = os.path.dirname(os.path.abspath(sys.argv[0]))
-        stop_sep=b'>>>+++STOP+++<<<'
-        go_sep=b'<<<+++GO+++>>>'
-        quit_cmd='quit'
-        subfolder_cmd='#_'
         ok_sound=os.path.join(current_path,'tones','ok.mp3')
         fail_sound=os.path.join(current_path,'tones','fail.mp3')
         log_file=os.path.join(current_path,"log","cpm_downloader.log")
 
         use_logfile=options['use_logfile']
-        configure_logging(use_logfile,logging, log_file, log_level)
+        configure_logging(use_logfile,logging,log_file,log_level,options['log_queue'],
+                          options['log_repeat_interval'])
         logger.info("Starting the app now")
         logger.info("Logging to:%s  at level: %s",str(log_file),str(log_level))
         logger.info("File storage: %s",file_path)
-        logger.info("Connecting to the serial port %s",ser_device)
+        reference=None
+        if options['reference']:
+            reference=cpm_dirlistcompare.Command.extract_files(
+                cpm_dirlistcompare.Command.listing_files(options['reference']),1)
+            if reference is None:
+                logger.error("reference %s could not be read",options['reference'])
+                return
+        if options['daemon']:
+            Command.serve_daemon(options,file_path,reference,(ok_sound,fail_sound))
+            return
+        if options['record']:
+            try:
+                Path(options['record']).mkdir(parents=True, exist_ok=True)
+            except OSError as err:
+                logger.exception("capture folder %s could not be made: %s",
+                                 options['record'],str(err))
+                return
+        image=None
+        if options['image']:
+            try:
+                image=DiskImage(options['image'],parse_geometry(options['geometry']))
+            except (ValueError, OSError) as err:
+                logger.exception("image %s could not be prepared: %s",options['image'],str(err))
+                return
+        writer=None
+        if options['batch'] or options['staging']:
+            try:
+                writer=cpm_batchwriter.BatchWriter(**Command.batch_options(options))
+            except OSError as err:
+                logger.exception("staging %s could not be prepared: %s",options['staging'],
+                                 str(err))
+                if image is not None:
+                    image.close()
+                return
+        read_timeout,frame_timeout=line_timeouts(ser_baud,options['read_timeout'],
+                                                 options['frame_timeout'])
+        receiver=Receiver(file_path,image,fail_sound,frame_timeout)
+        receiver.writer=writer
+        line_errors=not options['no_line_errors']
+        receiver.tracker=cpm_dirlistcompare.MissingTracker(reference)
+        if image is not None:
+            receiver.housekeeping_tasks.append(image.flush)
         try:
-            with serial.Serial(ser_device, ser_baud, rtscts=1) as ser:
-                if ser.is_open:
-                    logger.info("Serial line now open to accept requests")
-                else:
-                    logger.error("serial line could not be opened")
-                    playsound.playsound(fail_sound)
-                    return
-                logger.info("Application now in endless loop")
-                subfolder=file_path
-                while True:
-                    ser_content=ser.read_until(stop_sep)
-                    ser_content=ser_content[:-len(stop_sep)]
-                    ser_filename=ser.read_until(go_sep)
-                    ser_filename=ser_filename[:-len(go_sep)].decode('ascii').\
-                        lower().strip() #cut seperator
-                    if ser_filename == quit_cmd:
-                        break
-                    if ser_filename[0:2] == subfolder_cmd:
-                        subfoldername=ser_filename[2:].strip()
-                        subfolder=os.path.join(file_path,subfoldername)
-                        Path(subfolder).mkdir(parents=True, exist_ok=True)
-                        logger.info("Path has been set to %s",subfolder)
-                        continue
-                    try:
-                        ser_path=os.path.join(subfolder,ser_filename)
-                        with open(ser_path,'wb') as bin_file:
-                            bin_file.write(ser_content)
-                        logger.info(str(len(ser_content))+" Bytes now written to: "+\
-                            ser_filename+" onfolder "+subfolder)
-                        #playsound.playsound(ok_sound)
-
-                    except (IOError, OSError, TypeError) as ferr:
-                        logger.exception("file %s could not be written: %s",ser_path,str(ferr))
+            if options['replay']:
+                with CaptureReplay(options['replay'],
+                                   ser_baud if options['replay_paced'] else None) as replay:
+                    #raw captures contain unescaped 0xff, they must not be decoded
+                    receiver.error_marking=line_errors and replay.marked
+                    receiver.receive(replay)
+            else:
+                logger.info("Connecting to the serial port %s",ser_device)
+                with serial.Serial(ser_device, ser_baud, rtscts=1, timeout=read_timeout,
+                                   parity=options['parity']) as ser:
+                    if ser.is_open:
+                        logger.info("Serial line now open to accept requests")
+                    else:
+                        logger.error("serial line could not be opened")
                         playsound.playsound(fail_sound)
-                        break
+                        return
+                    if line_errors:
+                        receiver.error_marking=enable_error_marking(ser)
+                    logger.info("Application now in endless loop")
+                    if options['record']:
+                        try:
+                            recorder=CaptureRecorder(ser,capture_filename(options['record']),
+                                                     receiver.error_marking)
+                        except OSError as err:
+                            logger.exception("capture in %s could not be started: %s",
+                                             options['record'],str(err))
+                            playsound.playsound(fail_sound)
+                            return
+                        with recorder:
+                            receiver.housekeeping_tasks.append(recorder.flush)
+                            receiver.receive(recorder)
+                    else:
+                        receiver.receive(ser)
 
         except (ValueError, serial.SerialException, IOError) as err:
             logger.exception("I am sorry to inform you that the serial line could not be opened,"\
                 " cause: %s",str(err))
             playsound.playsound(fail_sound)
             return
+        finally:
+            if image is not None:
+                image.close()
+            if writer is not None:
+                writer.close()
 
         logger.info("Application terminated now")
         playsound.playsound(ok_sound)
+    @staticmethod
+    def batch_options(options):
+        """Arguments of the batch writer
+
+        Args:
+            options (dict): Commandline options
+
+        Returns:
+            dict: keyword arguments for BatchWriter, None if files are written one by one
+        """
+        if not options['batch'] and not options['staging']:
+            return None
+        return {"batch_size":options['batch'] or cpm_batchwriter.BATCH_SIZE,
+                "batch_interval":options['batch_interval'],"staging":options['staging'],
+                "sync":options['batch_sync']}
+
+    @staticmethod
+    def profile_conflict(options):
+        """Options the profilers can not cover, checked before the run is profiled
+
+        Args:
+            options (dict): Commandline options
+
+        Returns:
+            str: Why the run can not be profiled, None if it can
+        """
+        if options['daemon']:
+            #both profilers see the main thread only, not the threads serving the ports
+            return "--profile is not supported in daemon mode, profile a single port instead"
+        return None
+
+    @staticmethod
+    def serve_daemon(options, file_path, reference, sounds):
+        """Run as daemon serving all ports given, until it is shut down
+
+        Args:
+            options (dict): Commandline options
+            file_path (str): Output path, one subfolder per port if there are several
+            reference (list): Entries already transferred, None if not given
+            sounds (tuple): Sounds played after a session and on errors
+        """
+        if options['image'] or options['replay'] or options['record']:
+            logger.error("--image, --replay and --record are not supported in daemon mode")
+            return
+        devices=[device.strip() for device in options['device'].split(",") if device.strip()]
+        read_timeout,frame_timeout=line_timeouts(options['baud'],options['read_timeout'],
+                                                 options['frame_timeout'])
+        workers=[]
+        for device in devices:
+            port_path=file_path if len(devices)==1 else \
+                os.path.join(file_path,os.path.basename(device))
+            workers.append(cpm_daemon.PortWorker(device,port_path,options['baud'],
+                options['parity'],read_timeout,frame_timeout,not options['no_line_errors'],
+                reference,sounds,Command.batch_options(options)))
+        try:
+            for worker in workers:
+                Path(worker.file_path).mkdir(parents=True, exist_ok=True)
+            cpm_daemon.run_daemon(options['daemon'],workers)
+        except OSError as err:
+            logger.exception("daemon could not be started: %s",str(err))
+            playsound.playsound(sounds[1])
+            return
+        logger.info("Application terminated now")
+
+
 def main():
     '''
     Main function executed when the python script will be called
@@ -0,0 +1,477 @@
+#!/usr/bin/python3
+"""
+**Sender simulator for the downloader**
+
+Content
+#######
+Plays the CP/M side of a transfer on a plain Linux or macOS box: the files given are
+sent with the STOP/GO protocol through a pseudo terminal, the downloader reads the
+other end like a serial device. The simulator
+
+* paces the bytes at the baudrate, optionally with a random jitter per chunk
+* emulates RTS/CTS: the receive buffer of the pty is the buffer of the UART, once
+  ``--rx_buffer`` bytes are waiting there CTS drops and the sender waits.
+  With ``--no_cts`` the sender ignores it and the bytes not fitting are lost.
+* injects line errors, either as flipped bits or, for capture files only, as the
+  PARMRK marks a driver inserts (the line discipline of a pty escapes 0xff, so marks
+  can not be passed through it)
+
+At the end a report tells the stalls the receiver caused, the high-water mark of the
+receive buffer and the throughput achieved compared to the line rate.
+
+Info
+####
+* **author:** (c) Thomas Lüth 2024
+* **email:** info@tlc-it-consulting.com
+* **created:** 2024-03-11
+
+Code
+####
+"""
+import os
+import sys
+import time
+import tty
+import fcntl
+import glob
+import shlex
+import random
+import struct
+import termios
+import logging
+from tlu_utils import get_git_version,add_parser_log_args,cmdline_main,configure_logging,\
+    lazy_import
+from cpm_capture import BITS_PER_BYTE,write_capture_info
+
+#: Imported on first use
+json=lazy_import('json')
+subprocess=lazy_import('subprocess')
+cpm_downloader=lazy_import('cpm_downloader')
+
+logger = logging.getLogger(__name__)
+
+#: Bytes written to the line at once
+CHUNK_SIZE=64
+#: Bytes the receive buffer takes before CTS drops, stays below the 4k of the
+#: line discipline, beyond that TIOCINQ does not report the bytes waiting
+RX_BUFFER=4000
+#: Seconds the bytes written may take to show up at the pty slave
+SETTLE_TIME=0.005
+
+
+def session_frames(filenames, folder=None):
+    """Frames of a transfer session as sent by the CP/M side
+
+    Args:
+        filenames (list): Files to be sent
+        folder (str, optional): Subfolder selected before the files are sent
+
+    Yields:
+        bytes: frame of the STOP/GO protocol, the last one is quit
+    """
+    receiver=cpm_downloader.Receiver
+    if folder:
+        yield receiver.stop_sep+(receiver.subfolder_cmd+folder).encode('ascii')+receiver.go_sep
+    for filename in filenames:
+        with open(filename,"rb") as send_file:
+            content=send_file.read()
+        yield content+receiver.stop_sep+os.path.basename(filename).upper().encode('ascii')+\
+            receiver.go_sep
+    yield receiver.stop_sep+receiver.quit_cmd.upper().encode('ascii')+receiver.go_sep
+
+
+class LineErrorInjector():
+    """Damages bytes with the given probability like a noisy line
+    """
+    def __init__(self, rate=0.0, mode="flip", rng=None):
+        """Prepare the injector
+
+        Args:
+            rate (float, optional): Probability of an error per byte
+            mode (str, optional): flip changes one bit of the byte, mark inserts the
+                PARMRK mark a driver would deliver and escapes 0xff, a marked 0x00
+                is decoded as break and dropped
+            rng (random.Random, optional): Random generator, seeded for repeatable runs
+        """
+        self.rate=rate
+        self.mode=mode
+        self.rng=rng or random.Random()
+        self.injected=0
+
+    def apply(self, data):
+        """Inject the errors into the bytes to be sent
+
+        Args:
+            data (bytes): Bytes to be sent
+
+        Returns:
+            bytes: Bytes as the receiver gets them
+        """
+        mark=self.mode=="mark"
+        if self.rate<=0:
+            return data.replace(b'\xff',b'\xff\xff') if mark else data
+        damaged=bytearray()
+        for byte in data:
+            if self.rng.random()>=self.rate:
+                damaged+=b'\xff\xff' if mark and byte==0xff else bytes((byte,))
+                continue
+            self.injected+=1
+            if mark:
+                #a damaged 0x00 is reported like a break
+                damaged+=bytes((0xff,0,byte))
+            else:
+                damaged.append(byte^(1<<self.rng.randrange(8)))
+        return bytes(damaged)
+
+
+def input_queue(fd):
+    """Bytes waiting in the receive buffer of a terminal
+
+    Args:
+        fd (int): File descriptor of the terminal
+
+    Returns:
+        int: number of bytes not read so far
+    """
+    return struct.unpack('i',fcntl.ioctl(fd,termios.TIOCINQ,b'\0'*4))[0]
+
+
+class SenderSimulator():
+    """Sends bytes through the master side of a pty, paced at the baudrate and
+    honoring the emulated CTS, and collects the statistics for the report
+    """
+    def __init__(self, master, slave, baud, chunk=CHUNK_SIZE, rx_buffer=RX_BUFFER, #pylint: disable=too-many-arguments
+                 honor_cts=True, jitter=0.0, rng=None, max_stall=None):
+        """Prepare the simulator
+
+        Args:
+            master (int): File descriptor of the pty master, the sender side
+            slave (int): File descriptor of the pty slave, read by the receiver
+            baud (int): Baudrate to be emulated, 0 sends as fast as possible
+            chunk (int, optional): Bytes written at once
+            rx_buffer (int, optional): Bytes waiting at the receiver before CTS drops
+            honor_cts (bool, optional): Wait while CTS is dropped instead of losing bytes
+            jitter (float, optional): Maximum random delay in seconds added per chunk
+            rng (random.Random, optional): Random generator, seeded for repeatable runs
+            max_stall (float, optional): Seconds CTS may stay low before giving up,
+                None waits forever
+        """
+        self.master=master
+        self.slave=slave
+        self.baud=baud
+        self.chunk=chunk
+        self.rx_buffer=rx_buffer
+        self.honor_cts=honor_cts
+        self.jitter=jitter
+        self.rng=rng or random.Random()
+        self.max_stall=max_stall
+        self.sent=0
+        self.overruns=0
+        self.stalls=0
+        self.stalled=0.0
+        self.longest_stall=0.0
+        self.high_water=0
+        self.started=None
+        self.finished=None
+        self._next=0.0
+        self._stall_start=None
+        os.set_blocking(master,False)
+
+    def _char_time(self, count):
+        return count*BITS_PER_BYTE/self.baud if self.baud else 0.0
+
+    def _pace(self, count):
+        delay=self._char_time(count)
+        if self.jitter:
+            delay+=self.rng.uniform(0,self.jitter)
+        now=time.monotonic()
+        self._next=max(self._next,now)
+        if self._next>now:
+            time.sleep(self._next-now)
+        self._next+=delay
+
+    def _cts_low(self):
+        if self._stall_start is None:
+            self._stall_start=time.monotonic()
+            self.stalls+=1
+        elif self.max_stall is not None and time.monotonic()-self._stall_start>self.max_stall:
+            #the stall ends here, it is part of the report
+            self._cts_high()
+            raise TimeoutError(f"receiver did not read for {self.max_stall:.0f}s")
+
+    def _cts_high(self):
+        if self._stall_start is not None:
+            duration=time.monotonic()-self._stall_start
+            self.stalled+=duration
+            self.longest_stall=max(self.longest_stall,duration)
+            self._stall_start=None
+            #the line has been idle, no catching up afterwards
+            self._next=time.monotonic()
+
+    def _settle(self, waiting):
+        #the pty passes the bytes written to the slave asynchronously, wait a moment
+        #until they are counted, otherwise the receive buffer looks emptier than it is
+        deadline=time.monotonic()+SETTLE_TIME
+        while input_queue(self.slave)==waiting and time.monotonic()<deadline:
+            time.sleep(0)
+
+    def _write(self, data):
+        while data:
+            waiting=input_queue(self.slave)
+            self.high_water=max(self.high_water,waiting)
+            room=self.rx_buffer-waiting
+            if room<len(data) and not self.honor_cts:
+                lost=len(data)-max(room,0)
+                self.overruns+=lost
+                data=data[:max(room,0)]
+                if not data:
+                    return
+            try:
+                written=os.write(self.master,data[:room]) if room>0 else 0
+            except BlockingIOError:
+                written=0
+            if written:
+                self._cts_high()
+                self.sent+=written
+                data=data[written:]
+                self._settle(waiting)
+            elif self.honor_cts:
+                self._cts_low()
+                time.sleep(max(self._char_time(1),0.001))
+            else:
+                self.overruns+=len(data)
+                return
+
+    def send(self, data):
+        """Send the bytes, paced and with flow control
+
+        Args:
+            data (bytes): Bytes to be sent
+        """
+        if self.started is None:
+            self.started=time.monotonic()
+        try:
+            for start in range(0,len(data),self.chunk):
+                part=data[start:start+self.chunk]
+                self._pace(len(part))
+                self._write(part)
+        finally:
+            self.finished=time.monotonic()
+
+    def report(self):
+        """Statistics of the run
+
+        Returns:
+            dict: Counters, throughput in Bytes/s and efficiency compared to the line rate
+        """
+        elapsed=(self.finished or 0.0)-(self.started or 0.0)
+        throughput=self.sent/elapsed if elapsed>0 else 0.0
+        line_rate=self.baud/BITS_PER_BYTE if self.baud else 0.0
+        return {"sent":self.sent,"elapsed":round(elapsed,3),
+                "throughput":round(throughput,1),"line_rate":line_rate,
+                "efficiency":round(100*throughput/line_rate,1) if line_rate else None,
+                "stalls":self.stalls,"stalled":round(self.stalled,3),
+                "longest_stall":round(self.longest_stall,3),"high_water":self.high_water,
+                "overruns":self.overruns}
+
+
+def format_report(report):
+    """Human readable report
+
+    Args:
+        report (dict): Report of the run
+
+    Returns:
+        str: Report as text
+    """
+    lines=[f"{report['sent']} Bytes sent in {report['elapsed']:.1f}s, "\
+        f"{report['throughput']:.0f} Bytes/s"]
+    if report['line_rate']:
+        lines[0]+=f" of {report['line_rate']:.0f} ({report['efficiency']:.1f}%)"
+    if report.get('aborted'):
+        lines.insert(0,f"Session aborted: {report['aborted']}")
+    lines.append(f"Receiver stalls (CTS low): {report['stalls']}, {report['stalled']:.2f}s "\
+        f"in total, longest {report['longest_stall']:.2f}s")
+    lines.append(f"Receive buffer high-water mark: {report['high_water']} Bytes, "\
+        f"{report['overruns']} Bytes lost by overruns")
+    lines.append(f"Line errors injected: {report['errors_injected']}")
+    if report.get('receiver_exit') is not None:
+        lines.append(f"Receiver exit code: {report['receiver_exit']}")
+    return "\n".join(lines)
+
+
+class Command():
+    """
+    Commandline interface for the sender simulator
+
+    """
+    help = "Sends files through a pty like the CP/M side, paced and with emulated RTS/CTS, "\
+        "and reports how the receiver kept up"
+    @staticmethod
+    def add_arguments(parser):
+        '''
+        Add the commandline arguments that will be executed
+
+        :param parser: commandline parser
+        '''
+        add_parser_log_args(parser)
+        parser.add_argument('--files', help="Files to be sent, filename, glob pattern or folder",
+                            default="", required=False, action='store')
+        parser.add_argument('--folder', help="Subfolder selected with #_ before sending",
+                            default=None, required=False, action='store')
+        parser.add_argument('--baud', help="Baudrate emulated, 0 sends as fast as possible",
+                            type=int, default=19200, required=False, action='store')
+        parser.add_argument('--chunk', help="Bytes written at once", type=int,
+                            default=CHUNK_SIZE, required=False, action='store')
+        parser.add_argument('--jitter', help="Maximum random delay in seconds per chunk",
+                            type=float, default=0.0, required=False, action='store')
+        parser.add_argument('--rx_buffer', help="Bytes waiting at the receiver before "\
+                            "CTS drops", type=int, default=RX_BUFFER, required=False,
+                            action='store')
+        parser.add_argument('--no_cts', help="Ignore CTS, bytes not fitting into the "\
+                            "receive buffer are lost", required=False, action='store_true')
+        parser.add_argument('--error_rate', help="Probability of a line error per byte",
+                            type=float, default=0.0, required=False, action='store')
+        parser.add_argument('--error_mode', help="flip a bit or mark the error like PARMRK, "\
+                            "mark needs --capture", choices=['flip','mark'], default='flip',
+                            required=False, action='store')
+        parser.add_argument('--seed', help="Seed of the random generator for repeatable runs",
+                            type=int, default=None, required=False, action='store')
+        parser.add_argument('--run', help="Receiver command started with the pty as "\
+                            "{device}, eg. \"python3 cpm_downloader.py --device {device}\"",
+                            default=None, required=False, action='store')
+        parser.add_argument('--startup', help="Seconds to wait for the receiver before sending",
+                            type=float, default=5.0, required=False, action='store')
+        parser.add_argument('--wait', help="Seconds to wait for the receiver to finish",
+                            type=float, default=30.0, required=False, action='store')
+        parser.add_argument('--max_stall', help="Seconds CTS may stay low before the session "\
+                            "is aborted, 0 waits forever", type=float, default=60.0,
+                            required=False, action='store')
+        parser.add_argument('--capture', help="Write the stream into this capture file for "\
+                            "--replay instead of sending it", default=None, required=False,
+                            action='store')
+        parser.add_argument('--format', help="Format of the report", choices=['text','json'],
+                            default='text', required=False, action='store')
+
+    @staticmethod
+    def send_session(frames, options, injector):
+        """Send the frames through a new pty to the receiver
+
+        Args:
+            frames (iterable): Frames to be sent
+            options (dict): Commandline options
+            injector (LineErrorInjector): Injects the line errors
+
+        Returns:
+            dict: Report of the run
+        """
+        master,slave=os.openpty()
+        tty.setraw(slave)
+        device=os.ttyname(slave)
+        receiver=None
+        try:
+            if options['run']:
+                command=[part.replace("{device}",device) for part in shlex.split(options['run'])]
+                receiver=subprocess.Popen(command) #pylint: disable=consider-using-with
+            else:
+                print(f"Sending to {device}, start the receiver there",file=sys.stderr)
+            time.sleep(options['startup'])
+            simulator=SenderSimulator(master,slave,options['baud'],options['chunk'],
+                                      options['rx_buffer'],not options['no_cts'],
+                                      options['jitter'],injector.rng,
+                                      options['max_stall'] or None)
+            aborted=None
+            try:
+                for frame in frames:
+                    simulator.send(injector.apply(frame))
+            except TimeoutError as err:
+                logger.warning("Session aborted, %s",str(err))
+                aborted=str(err)
+            report=simulator.report()
+            if aborted is not None:
+                report['aborted']=aborted
+            elif receiver is not None:
+                try:
+                    report['receiver_exit']=receiver.wait(options['wait'])
+                except subprocess.TimeoutExpired:
+                    logger.warning("Receiver did not finish within %.0fs, stopped",
+                                   options['wait'])
+                    receiver.kill()
+                    report['receiver_exit']=receiver.wait()
+            else:
+                #the receiver reads the rest before the pty goes away
+                deadline=time.monotonic()+options['wait']
+                while input_queue(slave) and time.monotonic()<deadline:
+                    time.sleep(0.1)
+        finally:
+            if receiver is not None and receiver.poll() is None:
+                #the session was aborted or could not be sent
+                receiver.kill()
+                receiver.wait()
+            os.close(master)
+            os.close(slave)
+        return report
+
+    @staticmethod
+    def handle(*args, **options):  #pylint: disable=unused-argument
+        """
+        Main loop to process the commandline
+
+        """
+        if options['version']:
+            print("The current version is: "+get_git_version())
+            return
+        current_path = os.path.dirname(os.path.abspath(sys.argv[0]))
+        log_file=os.path.join(current_path,"log","cpm_downloader.log")
+        configure_logging(options['use_logfile'],logging,log_file,options['loglevel'],
+                          options['log_queue'],options['log_repeat_interval'])
+        if len(options['files'])<1:
+            logger.error("You have to provide the files to be sent, use --help for more info")
+            return
+        if options['error_mode']=="mark" and not options['capture']:
+            logger.error("Error marks can only be written to a --capture file, "\
+                "a pty escapes them")
+            return
+        if os.path.isdir(options['files']):
+            filenames=sorted(os.path.join(options['files'],name)
+                             for name in os.listdir(options['files'])
+                             if os.path.isfile(os.path.join(options['files'],name)))
+        else:
+            filenames=sorted(glob.glob(options['files'])) or [options['files']]
+        injector=LineErrorInjector(options['error_rate'],options['error_mode'],
+                                   random.Random(options['seed']))
+        frames=session_frames(filenames,options['folder'])
+        try:
+            if options['capture']:
+                sent=0
+                with open(options['capture'],"wb") as capture:
+                    for frame in frames:
+                        sent+=capture.write(injector.apply(frame))
+                #tells the replay whether to decode marks, flipped bits are raw bytes
+                write_capture_info(options['capture'],options['error_mode']=="mark")
+                report={"sent":sent,"capture":options['capture']}
+            else:
+                report=Command.send_session(frames,options,injector)
+        except OSError as err:
+            logger.exception("session could not be sent: %s",str(err))
+            return
+        report['errors_injected']=injector.injected
+        if options['format']=="json":
+            print(json.dumps(report))
+        elif options['capture']:
+            print(f"{report['sent']} Bytes written to {report['capture']}, "\
+                f"{report['errors_injected']} line errors injected")
+        else:
+            print(format_report(report))
+
+
+def main():
+    '''
+    Main function executed when the python script will be called
+
+    '''
+    cmd = Command()
+    cmdline_main(cmd)
+
+if __name__ == "__main__": # pragma: no cover
+    main()
@@ -0,0 +1,70 @@
+"""
+**Unit tests for the baseline store**
+
+Content
+#######
+This module tests to some extend the provided functionalities
+
+Info
+####
+* **author:** (c) Thomas Lüth 2024
+* **email:** info@tlc-it-consulting.com
+* **created:** 2024-02-16
+
+Code
+####
+"""
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+from cpm_baseline import BaselineStore, diff_sorted
+
+class TestBaseline(unittest.TestCase):
+    '''
+    Testing the baseline store
+    '''
+
+    def setUp(self):
+        self.tmpdir=tempfile.TemporaryDirectory() #pylint: disable=consider-using-with
+        self.filename=os.path.join(self.tmpdir.name,"baseline.db")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_diff_sorted(self):
+        """Test the merge walk over added, removed, changed and equal entries
+        """
+        old=[("F00_A.COM",4,25,"Dir RW"),("F00_B.COM",1,8,"Dir RW"),
+             ("F00_D.COM",2,16,"Dir RW"),("G01_Z.TXT",1,1,"Dir RW")]
+        new=[("F00_A.COM",4,25,"Dir RW"),("F00_C.COM",1,8,"Dir RW"),
+             ("F00_D.COM",3,24,"Dir RW")]
+        self.assertEqual(list(diff_sorted(old,new)),[("removed","F00_B.COM"),
+                                                     ("added","F00_C.COM"),
+                                                     ("changed","F00_D.COM"),
+                                                     ("removed","G01_Z.TXT")])
+        self.assertEqual(list(diff_sorted([],new[0:1])),[("added","F00_A.COM")])
+        self.assertEqual(list(diff_sorted(old,old)),[])
+
+    @mock.patch('cpm_baseline.logger')
+    def test_store(self,mock_logger):
+        """Test storing and reading snapshots per machine
+        """
+        with BaselineStore(self.filename) as store:
+            self.assertIsNone(store.latest("prof80"))
+            self.assertEqual(list(store.entries(None)),[])
+            first=store.store("prof80",[("F00_A.COM",4,25,"Dir RW")],"list.lst")
+            store.store("other",[("F00_X.COM",1,1,"Dir RW")])
+            second=store.store("prof80",[("G00_B.COM",1,8,"Sys RO"),
+                                         ("F00_A.COM",4,25,"Dir RW")])
+        with BaselineStore(self.filename) as store:
+            self.assertEqual(store.latest("prof80"),second)
+            self.assertEqual(list(store.entries(second)),[("F00_A.COM",4,25,"Dir RW"),
+                                                          ("G00_B.COM",1,8,"Sys RO")])
+            history=store.history("prof80")
+            self.assertEqual([snapshot[0] for snapshot in history],[first,second])
+            self.assertEqual(history[0][3],"list.lst")
+            self.assertEqual(history[1][4],2)
+            self.assertEqual(len(store.history()),3)
+        mock_logger.info.assert_called()
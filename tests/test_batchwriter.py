@@ -0,0 +1,190 @@
+"""
+**Unit tests for the batched output**
+
+Content
+#######
+This module tests to some extend the provided functionalities
+
+Info
+####
+* **author:** (c) Thomas Lüth 2024
+* **email:** info@tlc-it-consulting.com
+* **created:** 2024-03-18
+
+Code
+####
+"""
+
+import os
+import errno
+import resource
+import tempfile
+import unittest
+from unittest import mock
+from cpm_batchwriter import BatchWriter
+
+class TestBatchWriter(unittest.TestCase):
+    '''
+    Testing the batch writer
+    '''
+
+    def setUp(self):
+        self.tmpdir=tempfile.TemporaryDirectory() #pylint: disable=consider-using-with
+        self.output=os.path.join(self.tmpdir.name,"out")
+        self.staging=os.path.join(self.tmpdir.name,"staging")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def read(self, *names):
+        """Content of an output file
+
+        Returns:
+            bytes: Content
+        """
+        with open(os.path.join(self.output,*names),"rb") as out_file:
+            return out_file.read()
+
+    @mock.patch('cpm_batchwriter.logger')
+    @mock.patch('cpm_batchwriter.os.fsync')
+    def test_direct(self,mock_fsync,mock_logger):
+        """Test files are written right away and not synced, folders created once
+        """
+        folder=os.path.join(self.output,"g01")
+        with BatchWriter(batch_size=2) as writer:
+            with mock.patch('cpm_batchwriter.Path') as mock_path:
+                writer.ensure_dir(folder)
+                writer.ensure_dir(folder)
+                mock_path.assert_called_once_with(folder)
+                writer.known_dirs.clear()
+            writer.write(folder,"a.com",b'A')
+            writer.write(folder,"b.com",b'B')
+            self.assertEqual(writer.batches,1)
+            writer.write(folder,"a.com",b'AA')
+            self.assertEqual(self.read("g01","a.com"),b'AA')
+        self.assertEqual(writer.committed,3)
+        self.assertEqual(writer.batches,2)
+        mock_fsync.assert_not_called()
+        mock_logger.info.assert_called_once()
+
+    @mock.patch('cpm_batchwriter.logger')
+    @mock.patch('cpm_batchwriter.os.fsync')
+    def test_direct_sync(self,mock_fsync,mock_logger):
+        """Test files and folders are synced per batch if asked to
+        """
+        folder=os.path.join(self.output,"g01")
+        with BatchWriter(batch_size=2,sync=True) as writer:
+            writer.write(folder,"a.com",b'A')
+            writer.write(folder,"b.com",b'B')
+            self.assertEqual(writer.batches,1)
+            self.assertEqual(mock_fsync.call_count,3)
+            writer.write(folder,"a.com",b'AA')
+            self.assertEqual(self.read("g01","a.com"),b'AA')
+            self.assertEqual(len(writer.pending),1)
+        self.assertEqual(writer.committed,3)
+        self.assertEqual(mock_fsync.call_count,5)
+        self.assertEqual(writer.batches,2)
+        self.assertEqual(writer.failed,0)
+        mock_logger.info.assert_called_once()
+
+    @mock.patch('cpm_batchwriter.logger')
+    def test_no_open_files(self,mock_logger):
+        """Test a batch larger than the descriptor limit, no file is kept open
+        """
+        soft,hard=resource.getrlimit(resource.RLIMIT_NOFILE)
+        writer=BatchWriter(batch_size=1000)
+        resource.setrlimit(resource.RLIMIT_NOFILE,(64,hard))
+        try:
+            for number in range(200):
+                writer.write(self.output,f"f{number:03d}.com",b'X')
+            writer.close()
+        finally:
+            resource.setrlimit(resource.RLIMIT_NOFILE,(soft,hard))
+        self.assertEqual(writer.committed,200)
+        self.assertEqual(writer.failed,0)
+        mock_logger.exception.assert_not_called()
+
+    @mock.patch('cpm_batchwriter.logger')
+    def test_interval(self,mock_logger):
+        """Test a batch is committed once its interval has passed
+        """
+        writer=BatchWriter(batch_size=10,batch_interval=0)
+        writer.write(self.output,"a.com",b'A')
+        self.assertEqual(writer.pending,[])
+        writer.batch_interval=60
+        writer.write(self.output,"b.com",b'B')
+        writer.commit_due()
+        self.assertEqual(len(writer.pending),1)
+        writer.close()
+        self.assertEqual(writer.committed,2)
+        mock_logger.debug.assert_called()
+
+    @mock.patch('cpm_batchwriter.logger')
+    def test_staging(self,mock_logger):
+        """Test staged files show up in the output at the end of the batch only
+        """
+        writer=BatchWriter(batch_size=3,staging=self.staging)
+        writer.write(os.path.join(self.output,"g01"),"a.com",b'A1')
+        writer.write(os.path.join(self.output,"g02"),"b.com",b'B')
+        self.assertFalse(os.path.exists(os.path.join(self.output,"g02","b.com")))
+        writer.write(os.path.join(self.output,"g01"),"a.com",b'A2')
+        writer.write(self.output,"c.com",b'C')
+        self.assertEqual(self.read("g01","a.com"),b'A2')
+        self.assertEqual(self.read("g02","b.com"),b'B')
+        self.assertFalse(os.path.exists(os.path.join(self.output,"c.com")))
+        writer.close()
+        self.assertEqual(self.read("c.com"),b'C')
+        self.assertEqual(writer.committed,3)
+        self.assertEqual(os.listdir(self.staging),[])
+        mock_logger.info.assert_called()
+
+    @mock.patch('cpm_batchwriter.logger')
+    def test_staging_other_device(self,mock_logger):
+        """Test staged files are copied and renamed if they can not be moved
+        """
+        def replace(source,target):
+            if source.startswith(self.staging):
+                raise OSError(errno.EXDEV,"Invalid cross-device link")
+            os.rename(source,target)
+        writer=BatchWriter(staging=self.staging)
+        with mock.patch('cpm_batchwriter.os.replace',side_effect=replace), \
+            mock.patch('cpm_batchwriter.os.fsync') as mock_fsync:
+            writer.write(self.output,"a.com",b'A')
+            writer.close()
+        mock_fsync.assert_not_called()
+        self.assertEqual(os.listdir(self.output),["a.com"])
+        self.assertEqual(self.read("a.com"),b'A')
+        self.assertEqual(os.listdir(self.staging),[])
+        mock_logger.exception.assert_not_called()
+
+    @mock.patch('cpm_batchwriter.logger')
+    def test_staging_failed(self,mock_logger):
+        """Test files that can not be moved are counted and kept in the staging folder
+        """
+        writer=BatchWriter(staging=self.staging)
+        blocker=os.path.join(self.tmpdir.name,"file")
+        with open(blocker,"wb"):
+            pass
+        writer.write(os.path.join(blocker,"g01"),"a.com",b'A')
+        writer.write(self.output,"b.com",b'B')
+        writer.close()
+        self.assertEqual(writer.failed,1)
+        self.assertEqual(writer.committed,1)
+        self.assertEqual(len(os.listdir(writer.staging)),1)
+        mock_logger.exception.assert_called_once()
+        mock_logger.warning.assert_called_once()
+
+    @mock.patch('cpm_batchwriter.logger')
+    def test_staging_unlink_failed(self,mock_logger):
+        """Test a staged file that can not be removed does not stop the batch
+        """
+        writer=BatchWriter(staging=self.staging)
+        writer.write(self.output,"a.com",b'A1')
+        writer.write(self.output,"a.com",b'A2')
+        writer.write(self.output,"b.com",b'B')
+        with mock.patch('cpm_batchwriter.os.unlink',side_effect=OSError("busy")):
+            self.assertEqual(writer.commit(),2)
+        self.assertEqual(self.read("a.com"),b'A2')
+        self.assertEqual(self.read("b.com"),b'B')
+        self.assertEqual(writer.failed,1)
+        mock_logger.exception.assert_called_once()
@@ -0,0 +1,119 @@
+"""
+**Unit tests for the capture and replay**
+
+Content
+#######
+This module tests to some extend the provided functionalities
+
+Info
+####
+* **author:** (c) Thomas Lüth 2024
+* **email:** info@tlc-it-consulting.com
+* **created:** 2024-02-07
+
+Code
+####
+"""
+
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock
+from unittest import mock
+from cpm_capture import CaptureRecorder, CaptureReplay, capture_filename, capture_marked
+
+class TestCapture(unittest.TestCase):
+    '''
+    Testing capture and replay
+    '''
+
+    def setUp(self):
+        self.tmpdir=tempfile.TemporaryDirectory() #pylint: disable=consider-using-with
+        self.filename=os.path.join(self.tmpdir.name,"test.cap")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write_capture(self,content):
+        """Writes a capture file
+
+        Args:
+            content (bytes): Content of the capture
+        """
+        with open(self.filename,"wb") as cap:
+            cap.write(content)
+
+    def test_capture_filename(self):
+        """Test the timestamped name
+        """
+        name=capture_filename(self.tmpdir.name)
+        self.assertTrue(name.startswith(os.path.join(self.tmpdir.name,"cpm_")))
+        self.assertTrue(name.endswith(".cap"))
+
+    @mock.patch('cpm_capture.logger')
+    def test_recorder(self,mock_logger):
+        """Test the recorder appends all bytes read
+        """
+        line=MagicMock()
+        line.read_until=MagicMock(side_effect=[b'abc',b'def'])
+        line.is_open=True
+        self.write_capture(b'old')
+        with CaptureRecorder(line,self.filename) as recorder:
+            self.assertEqual(recorder.read_until(b'c'),b'abc')
+            self.assertEqual(recorder.read_until(b'f',size=10),b'def')
+            self.assertTrue(recorder.is_open)
+        line.read_until.assert_called_with(b'f',size=10)
+        with open(self.filename,"rb") as cap:
+            self.assertEqual(cap.read(),b'oldabcdef')
+        self.assertEqual(recorder.recorded,6)
+        self.assertFalse(capture_marked(self.filename))
+        mock_logger.info.assert_called()
+
+    @mock.patch('cpm_capture.logger')
+    def test_marked(self,mock_logger):
+        """Test the replay knows whether the capture has line error marks
+        """
+        self.write_capture(b'\xff\x00x')
+        with CaptureReplay(self.filename) as replay:
+            self.assertFalse(replay.marked)
+        with CaptureRecorder(MagicMock(),self.filename,marked=True):
+            pass
+        with CaptureReplay(self.filename) as replay:
+            self.assertTrue(replay.marked)
+        with open(self.filename+".info","w",encoding='utf-8') as info:
+            info.write("garbage")
+        self.assertFalse(capture_marked(self.filename))
+        mock_logger.info.assert_called()
+
+    @mock.patch('cpm_capture.logger')
+    def test_replay(self,mock_logger):
+        """Test reading until separators, size and end of capture
+        """
+        self.write_capture(b'data>>STOP<<name<<GO>>rest')
+        with CaptureReplay(self.filename) as replay:
+            self.assertEqual(replay.read_until(b'>>STOP<<'),b'data>>STOP<<')
+            self.assertEqual(replay.read_until(b'<<GO>>',size=2),b'na')
+            self.assertEqual(replay.read_until(b'<<GO>>'),b'me<<GO>>')
+            self.assertEqual(replay.read_until(b'>>STOP<<'),b'rest')
+            self.assertRaises(EOFError,replay.read_until,b'>>STOP<<')
+        self.assertFalse(replay.is_open)
+        mock_logger.info.assert_called()
+
+    @mock.patch('cpm_capture.CAPTURE_BUFFER',3)
+    def test_replay_small_chunks(self):
+        """Test separators spanning several reads of the capture
+        """
+        self.write_capture(b'data>>STOP<<x')
+        with CaptureReplay(self.filename) as replay:
+            self.assertEqual(replay.read_until(b'>>STOP<<'),b'data>>STOP<<')
+            self.assertEqual(replay.read_until(b'>>STOP<<'),b'x')
+
+    @mock.patch('cpm_capture.time')
+    def test_replay_paced(self,mock_time):
+        """Test the replay sleeps to keep the baudrate
+        """
+        mock_time.monotonic=MagicMock(return_value=0.0)
+        self.write_capture(b'x'*30)
+        with CaptureReplay(self.filename,baud=300) as replay:
+            replay.read_until(b'>>STOP<<')
+        mock_time.sleep.assert_called_once_with(1.0)
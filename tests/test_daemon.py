@@ -0,0 +1,169 @@
+"""
+**Unit tests for the daemon mode**
+
+Content
+#######
+This module tests to some extend the provided functionalities
+
+Info
+####
+* **author:** (c) Thomas Lüth 2024
+* **email:** info@tlc-it-consulting.com
+* **created:** 2024-03-04
+
+Code
+####
+"""
+
+import os
+import json
+import socket
+import tempfile
+import unittest
+import threading
+from unittest.mock import MagicMock
+from unittest import mock
+from cpm_daemon import PortWorker, SessionGate, ControlServer, run_daemon
+
+class TestDaemon(unittest.TestCase):
+    '''
+    Testing the daemon mode
+    '''
+
+    def setUp(self):
+        self.tmpdir=tempfile.TemporaryDirectory() #pylint: disable=consider-using-with
+        self.socket_path=os.path.join(self.tmpdir.name,"cpm.sock")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    @mock.patch('cpm_daemon.PAUSE_POLL',0.01)
+    def test_gate(self):
+        """Test reads wait while paused and end the session once stopped
+        """
+        worker=PortWorker("/dev/test",self.tmpdir.name,19200)
+        line=MagicMock()
+        line.read_until=MagicMock(return_value=b'data')
+        gate=SessionGate(line,worker)
+        self.assertEqual(gate.read_until(b'x'),b'data')
+        worker.pause()
+        self.assertEqual(worker.status(),"closed")
+        timer=threading.Timer(0.05,worker.stop)
+        timer.start()
+        self.assertRaises(EOFError,gate.read_until,b'x')
+        timer.join()
+        line.read_until.assert_called_once_with(b'x')
+
+    @mock.patch('playsound.playsound')
+    @mock.patch('cpm_daemon.logger')
+    @mock.patch('cpm_downloader.logger')
+    @mock.patch('cpm_daemon.serial')
+    def test_sessions(self,mock_ser,mock_logger,mock_daemon_logger,mock_sound):
+        """Test quit ends the session only, the port stays open for the next one
+        """
+        worker=PortWorker("/dev/test",self.tmpdir.name,19200,line_errors=False)
+        second=os.path.join(self.tmpdir.name,"second")
+        frames=iter([b'Data1>>>+++STOP+++<<<',b'FILE1.TXT<<<+++GO+++>>>',
+            b'>>>+++STOP+++<<<',None,b'QUIT<<<+++GO+++>>>',
+            b'Data22>>>+++STOP+++<<<',b'FILE2.TXT<<<+++GO+++>>>',
+            b'>>>+++STOP+++<<<',b'QUIT<<<+++GO+++>>>'])
+        def read_until(*args): #pylint: disable=unused-argument
+            data=next(frames,b'')
+            if data is None:
+                #valid from the next session on
+                worker.set_path(second)
+                data=next(frames)
+            elif not data:
+                worker.stop()
+            return data
+        ser=mock_ser.Serial.return_value.__enter__.return_value
+        ser.read_until=MagicMock(side_effect=read_until)
+        worker.run()
+        mock_ser.Serial.assert_called_once()
+        self.assertEqual(worker.sessions,2)
+        self.assertEqual(worker.totals["files"],2)
+        self.assertEqual(worker.totals["written"],11)
+        self.assertEqual(worker.state,"stopped")
+        self.assertEqual(mock_sound.call_count,2)
+        self.assertTrue(os.path.exists(os.path.join(self.tmpdir.name,"file1.txt")))
+        self.assertTrue(os.path.exists(os.path.join(second,"file2.txt")))
+        self.assertEqual(worker.stats()["session"]["frames"],0)
+        mock_logger.info.assert_called()
+        mock_daemon_logger.info.assert_called()
+
+    @mock.patch('cpm_daemon.REOPEN_INTERVAL',0)
+    @mock.patch('cpm_daemon.logger')
+    @mock.patch('cpm_daemon.serial')
+    def test_port_failed(self,mock_ser,mock_logger):
+        """Test a port that can not be opened is tried again
+        """
+        worker=PortWorker("/dev/test",self.tmpdir.name,19200)
+        mock_ser.SerialException=IOError
+        def failing(*args,**kwargs): #pylint: disable=unused-argument
+            if mock_ser.Serial.call_count>=2:
+                worker.stop()
+            raise IOError("no such device")
+        mock_ser.Serial=MagicMock(side_effect=failing)
+        worker.run()
+        self.assertEqual(mock_ser.Serial.call_count,2)
+        self.assertEqual(mock_logger.exception.call_count,2)
+
+    @mock.patch('cpm_daemon.logger')
+    def test_control_commands(self,mock_logger):
+        """Test the commands of the control socket
+        """
+        worker=PortWorker("/dev/test",self.tmpdir.name,19200)
+        server=ControlServer(self.socket_path,[worker])
+        try:
+            self.assertEqual(server.execute("ports"),{"ok":True,"ports":[
+                {"device":"/dev/test","path":self.tmpdir.name,"state":"closed"}]})
+            worker.state="open"
+            self.assertEqual(server.execute("pause")["paused"],["/dev/test"])
+            self.assertEqual(server.execute("stats /dev/test")["stats"][0]["state"],"paused")
+            self.assertTrue(server.execute("RESUME /dev/test")["ok"])
+            self.assertTrue(worker.resumed.is_set())
+            new_path=os.path.join(self.tmpdir.name,"new")
+            self.assertTrue(server.execute("path /dev/test "+new_path)["ok"])
+            self.assertTrue(os.path.isdir(new_path))
+            self.assertEqual(worker.file_path,new_path)
+            self.assertFalse(server.execute("pause /dev/other")["ok"])
+            self.assertFalse(server.execute("path /dev/test")["ok"])
+            self.assertFalse(server.execute("unknown")["ok"])
+        finally:
+            server.server_close()
+        mock_logger.info.assert_called()
+
+    @mock.patch('cpm_daemon.logger')
+    def test_run_daemon(self,mock_logger):
+        """Test the daemon answers on the socket and stops its ports on shutdown
+        """
+        worker=MagicMock()
+        worker.device="/dev/test"
+        worker.file_path=self.tmpdir.name
+        worker.status=MagicMock(return_value="open")
+        with open(self.socket_path,"w",encoding='utf-8'):
+            pass
+        daemon=threading.Thread(target=run_daemon,args=(self.socket_path,[worker]))
+        daemon.start()
+        try:
+            for _ in range(100):
+                if os.path.exists(self.socket_path) and \
+                    os.stat(self.socket_path).st_mode&0o170000==0o140000:
+                    break
+                threading.Event().wait(0.01)
+            with socket.socket(socket.AF_UNIX,socket.SOCK_STREAM) as client:
+                client.connect(self.socket_path)
+                stream=client.makefile("rwb")
+                stream.write(b'ports\n\nshutdown\n')
+                stream.flush()
+                ports=json.loads(stream.readline())
+                self.assertTrue(json.loads(stream.readline())["ok"])
+        finally:
+            daemon.join(10)
+        self.assertEqual(ports["ports"][0]["state"],"open")
+        self.assertFalse(daemon.is_alive())
+        self.assertFalse(os.path.exists(self.socket_path))
+        worker.start.assert_called_once()
+        worker.stop.assert_called_once()
+        worker.join.assert_called_once()
+        mock_logger.info.assert_called()
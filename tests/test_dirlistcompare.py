@@ -15,12 +15,15 @@ Code
 ####
 """
 
+import os
+import json
+import tempfile
 import unittest
 import argparse
 from unittest.mock import MagicMock, mock_open
 from unittest import mock
 import pytest
-from cpm_dirlistcompare import Command, DirFileState, main
+from cpm_dirlistcompare import Command, DirFileState, ListingParser, MissingTracker, main
 
 class TestDirlistCompare(unittest.TestCase):
     '''
@@ -197,6 +200,233 @@ class TestDirlistCompare(unittest.TestCase):
         self.start_handler(options)
         mock_print.assert_called()
         mock_logger.info.assert_called()
+    def test_listing_files(self):
+        """Test files, glob patterns and folders
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for name in ["b.lst","A.LST","c.txt"]:
+                with open(os.path.join(tmpdir,name),"w",encoding='ascii') as listing:
+                    listing.write(self.file_sample)
+            self.assertEqual(Command.listing_files(tmpdir),
+                             [os.path.join(tmpdir,"A.LST"),os.path.join(tmpdir,"b.lst")])
+            self.assertEqual(Command.listing_files(os.path.join(tmpdir,"*.txt")),
+                             [os.path.join(tmpdir,"c.txt")])
+            self.assertEqual(Command.listing_files(os.path.join(tmpdir,"x.lst")),
+                             [os.path.join(tmpdir,"x.lst")])
+
+    @mock.patch('cpm_dirlistcompare.Command.extract_file')
+    def test_extract_files_merge(self,mock_extract):
+        """Test merging without duplicates in one process
+        """
+        mock_extract.side_effect=[["F00_A.F","F00_B.F"],["F00_B.F","F01_C.F"]]
+        ret_val=Command.extract_files(["file1","file2"],1)
+        self.assertEqual(ret_val,["F00_A.F","F00_B.F","F01_C.F"])
+        mock_extract.side_effect=[["F00_A.F"],None]
+        self.assertIsNone(Command.extract_files(["file1","file2"],1))
+
+    def test_extract_files_parallel(self):
+        """Test parsing several files in a process pool
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filenames=[]
+            for drive in "FGH":
+                filename=os.path.join(tmpdir,f"{drive}.lst")
+                with open(filename,"w",encoding='ascii') as listing:
+                    listing.write(self.file_sample.replace("Drive F:",f"Drive {drive}:"))
+                filenames.append(filename)
+            ret_val=Command.extract_files(filenames,2)
+        self.assertEqual(len(ret_val),6)
+        self.assertEqual(ret_val[0],"F00_ALLFILES.LST")
+        self.assertEqual(ret_val[-1],"H00_CCP.COM")
+
+    @mock.patch('cpm_dirlistcompare.os.cpu_count',return_value=4)
+    def test_pool_size(self,mock_cpus):
+        """Test small listings are parsed without process pool unless asked for
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filenames=[]
+            for name in "abc":
+                filenames.append(os.path.join(tmpdir,f"{name}.lst"))
+                with open(filenames[-1],"w",encoding='ascii') as listing:
+                    listing.write(self.file_sample)
+            self.assertEqual(Command.pool_size(0,filenames),1)
+            self.assertEqual(Command.pool_size(2,filenames),2)
+            self.assertEqual(Command.pool_size(8,filenames),3)
+            with mock.patch('cpm_dirlistcompare.POOL_MIN_BYTES',len(self.file_sample)*3):
+                self.assertEqual(Command.pool_size(0,filenames),3)
+                self.assertEqual(Command.pool_size(0,filenames[1:]+["missing.lst"]),1)
+        mock_cpus.assert_called()
+
+    @mock.patch('cpm_dirlistcompare.Command.extract_file')
+    @mock.patch('cpm_dirlistcompare.futures')
+    def test_compare_files_one_pool(self,mock_futures,mock_extract):
+        """Test both sides are parsed in the same process pool
+        """
+        executor=mock_futures.ProcessPoolExecutor.return_value
+        executor.map.side_effect=lambda extract,filenames,chunksize: map(extract,filenames)
+        mock_extract.side_effect=[["F00_A.F"],["F00_B.F"],["F00_A.F"],["F01_C.F"],[]]
+        with mock.patch('cpm_dirlistcompare.Command.listing_files',
+                        side_effect=[["a1","a2"],["b1","b2","b3"]]):
+            results=list(Command.compare_files("one","two",2))
+        self.assertEqual(results,[("missing","F00_B.F")])
+        mock_futures.ProcessPoolExecutor.assert_called_once()
+        self.assertEqual(executor.map.call_count,2)
+        executor.shutdown.assert_called_once()
+
+    @mock.patch('cpm_dirlistcompare.logger')
+    def test_handler_folders(self,mock_logger):
+        """Test a run with two folders relative to the working directory
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for side,drive in (("one","G"),("two","F")):
+                os.mkdir(os.path.join(tmpdir,side))
+                with open(os.path.join(tmpdir,side,"list.lst"),"w",encoding='ascii') as listing:
+                    listing.write(self.file_sample.replace("Drive F:",f"Drive {drive}:"))
+            cwd=os.getcwd()
+            os.chdir(tmpdir)
+            try:
+                options = self.parser.parse_args(["--file1", "one", "--file2", "two",
+                                                  "--output", "result.txt"])
+                self.start_handler(options)
+            finally:
+                os.chdir(cwd)
+            with open(os.path.join(tmpdir,"result.txt"),"r",encoding='utf-8') as result:
+                self.assertEqual(result.read(),
+                                 "\nResults:\n========\nG00_ALLFILES.LST\nG00_CCP.COM\n")
+        mock_logger.error.assert_not_called()
+
+    def run_format(self,output_format):
+        """Runs a comparison with the given output format into a file
+
+        Args:
+            output_format (String): format to be used
+
+        Returns:
+            String: Content of the output
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            output=os.path.join(tmpdir,"result")
+            with mock.patch('cpm_dirlistcompare.Command.extract_file') as mock_extract:
+                mock_extract.side_effect=[["F00_A.F","G01_B.COM","F00_C.F","F04_X.LST"],
+                                          ["F00_A.F"]]
+                options = self.parser.parse_args(["--file1", "file1", "--file2", "file2",
+                                                  "--format", output_format, "--output", output])
+                self.start_handler(options)
+            with open(output,"r",encoding='utf-8') as result:
+                return result.read()
+
+    @mock.patch('cpm_dirlistcompare.logger')
+    def test_handler_jsonl(self,mock_logger):
+        """Test JSON lines output
+        """
+        lines=self.run_format("jsonl").splitlines()
+        self.assertEqual(len(lines),2)
+        self.assertEqual(json.loads(lines[0]),{"entry":"G01_B.COM","drive":"G","user":"01",
+                                               "file":"B.COM","status":"missing"})
+        mock_logger.error.assert_not_called()
+
+    @mock.patch('cpm_dirlistcompare.logger')
+    def test_handler_csv(self,mock_logger):
+        """Test CSV output
+        """
+        lines=self.run_format("csv").splitlines()
+        self.assertEqual(lines[0],"entry,drive,user,file,status")
+        self.assertEqual(lines[1],"G01_B.COM,G,01,B.COM,missing")
+        self.assertEqual(len(lines),3)
+        mock_logger.error.assert_not_called()
+
+    @mock.patch('cpm_dirlistcompare.logger')
+    def test_handler_summary(self,mock_logger):
+        """Test the summary output
+        """
+        summary=json.loads(self.run_format("summary"))
+        self.assertEqual(summary,{"total":2,"drives":{"F":{"00":1},"G":{"01":1}}})
+        mock_logger.error.assert_not_called()
+
+    @mock.patch('cpm_dirlistcompare.logger')
+    @mock.patch('cpm_dirlistcompare.Command.extract_file')
+    def test_handler_output_failed(self,mock_extract,mock_logger):
+        """Test an output file that could not be opened
+        """
+        mock_extract.side_effect=[["F00_A.F"],["F00_B.F"]]
+        options = self.parser.parse_args(["--file1", "file1", "--file2", "file2",
+                                          "--output", "/nonexisting/result"])
+        self.start_handler(options)
+        mock_logger.exception.assert_called_once()
+
+    @mock.patch('cpm_dirlistcompare.logger')
+    def test_extract_entries(self,mock_logger):
+        """Test the extraction with details
+        """
+        with mock.patch('builtins.open', mock_open(read_data=self.file_sample)):
+            ret_val=Command.extract_entries("testfile.lst")
+        self.assertEqual(ret_val,[("F00_ALLFILES.LST",0,0,"Dir RW"),("F00_CCP.COM",4,25,"Sys RW")])
+        mock_logger.assert_not_called()
+
+    @mock.patch('cpm_dirlistcompare.logger')
+    @mock.patch('builtins.print')
+    def test_handler_baseline(self,mock_print,mock_logger):
+        """Test two runs against a baseline and the history
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            listing=os.path.join(tmpdir,"list.lst")
+            baseline=os.path.join(tmpdir,"baseline.db")
+            output=os.path.join(tmpdir,"result.csv")
+            with open(listing,"w",encoding='ascii') as listing_file:
+                listing_file.write(self.file_sample)
+            args=["--file1",listing,"--baseline",baseline,"--machine","prof80",
+                  "--format","csv","--output",output]
+            self.start_handler(self.parser.parse_args(args))
+            with open(output,"r",encoding='utf-8') as result:
+                self.assertEqual(len(result.read().splitlines()),3)
+            with open(listing,"w",encoding='ascii') as listing_file:
+                listing_file.write(self.file_sample.replace("CCP      COM     4k     25",
+                                                            "CCP      COM     5k     33"))
+            self.start_handler(self.parser.parse_args(args))
+            with open(output,"r",encoding='utf-8') as result:
+                self.assertEqual(result.read().splitlines()[1:],
+                                 ["F00_CCP.COM,F,00,CCP.COM,changed"])
+            self.start_handler(self.parser.parse_args(["--baseline",baseline,"--history",
+                                                       "--machine","prof80"]))
+        self.assertEqual(mock_print.call_count,2)
+        mock_logger.error.assert_not_called()
+
+    @mock.patch('cpm_dirlistcompare.logger')
+    def test_handler_baseline_errors(self,mock_logger):
+        """Test a baseline without file and one that can not be opened
+        """
+        self.start_handler(self.parser.parse_args(["--baseline","baseline.db"]))
+        mock_logger.error.assert_called_once()
+        self.start_handler(self.parser.parse_args(["--baseline","/nonexisting/baseline.db",
+                                                   "--file1","file1"]))
+        mock_logger.exception.assert_called_once()
+
+    def test_listing_parser_chunks(self):
+        """Test feeding a listing in chunks splitting the lines
+        """
+        parser=ListingParser()
+        found=[]
+        for pos in range(0,len(self.file_sample),7):
+            found+=parser.feed(self.file_sample[pos:pos+7])
+        found+=parser.close()
+        self.assertEqual([entry[0] for entry in found],["F00_ALLFILES.LST","F00_CCP.COM"])
+        self.assertEqual(parser.entries,found)
+
+    def test_missing_tracker(self):
+        """Test the files still missing against reference and received files
+        """
+        tracker=MissingTracker(["F00_ALLFILES.LST"])
+        tracker.file_received("G00_CCP.COM")
+        tracker.start_listing()
+        tracker.feed(self.file_sample.replace("Drive F:","Drive G:").encode('ascii'))
+        self.assertEqual(tracker.end_listing(),1)
+        self.assertEqual(tracker.missing,{"G00_ALLFILES.LST"})
+        tracker.feed(self.file_sample.encode('ascii')[:-1])
+        self.assertEqual(tracker.end_listing(),2)
+        self.assertEqual(tracker.listed,4)
+        tracker.file_received("F00_CCP.COM")
+        self.assertEqual(tracker.missing,{"G00_ALLFILES.LST"})
+
 
     @mock.patch('cpm_dirlistcompare.Command')
     @mock.patch('cpm_dirlistcompare.cmdline_main')
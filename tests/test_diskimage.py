@@ -0,0 +1,149 @@
+"""
+**Unit tests for the disk image reassembly**
+
+Content
+#######
+This module tests to some extend the provided functionalities
+
+Info
+####
+* **author:** (c) Thomas Lüth 2024
+* **email:** info@tlc-it-consulting.com
+* **created:** 2024-02-05
+
+Code
+####
+"""
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+from cpm_diskimage import DiskImage, DiskGeometry, parse_geometry, track_number
+
+class TestDiskImage(unittest.TestCase):
+    '''
+    Testing the disk image
+    '''
+
+    def setUp(self):
+        self.tmpdir=tempfile.TemporaryDirectory() #pylint: disable=consider-using-with
+        self.filename=os.path.join(self.tmpdir.name,"disk.img")
+        self.geometry=DiskGeometry("test",4,2,8)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_parse_geometry(self):
+        """Test known profile and spec
+        """
+        self.assertEqual(parse_geometry("8sssd").image_size,77*26*128)
+        geometry=parse_geometry("10:5:256")
+        self.assertEqual(geometry.tracks,10)
+        self.assertEqual(geometry.track_size,5*256)
+
+    def test_parse_geometry_invalid(self):
+        """Test invalid specs
+        """
+        self.assertRaises(ValueError,parse_geometry,"unknown")
+        self.assertRaises(ValueError,parse_geometry,"1:x:128")
+        self.assertRaises(ValueError,parse_geometry,"0:26:128")
+
+    def test_track_number(self):
+        """Test the track detection from filenames
+        """
+        self.assertEqual(track_number("t012.trk"),12)
+        self.assertEqual(track_number("g01track7.trk"),7)
+        self.assertIsNone(track_number("track.trk"))
+        self.assertIsNone(track_number("t012.com"))
+
+    @mock.patch('cpm_diskimage.logger')
+    def test_out_of_order(self,mock_logger):
+        """Test tracks out of order, retried and missing
+        """
+        image=DiskImage(self.filename,self.geometry)
+        self.assertTrue(image.write_track(2,b'C'*16))
+        self.assertTrue(image.write_track(0,b'X'*16))
+        self.assertTrue(image.write_track(0,b'A'*16))
+        missing=image.close()
+        self.assertEqual(missing,[1,3])
+        self.assertEqual(image.retried,1)
+        mock_logger.warning.assert_called_once()
+        with open(self.filename,"rb") as img:
+            content=img.read()
+        self.assertEqual(len(content),64)
+        self.assertEqual(content[0:16],b'A'*16)
+        self.assertEqual(content[32:48],b'C'*16)
+
+    @mock.patch('cpm_diskimage.logger')
+    def test_wrong_sizes(self,mock_logger):
+        """Test short, long and out of range tracks
+        """
+        image=DiskImage(self.filename,self.geometry)
+        self.assertTrue(image.write_track(0,b'X'*16))
+        self.assertTrue(image.write_track(0,b'S'*4))
+        self.assertTrue(image.write_track(1,b'L'*20))
+        self.assertFalse(image.write_track(4,b'O'*16))
+        self.assertEqual(image.close(),[0,2,3])
+        mock_logger.error.assert_called_once()
+        self.assertEqual(image.short,{0})
+        with open(self.filename,"rb") as img:
+            content=img.read()
+        self.assertEqual(len(content),64)
+        self.assertEqual(content[0:16],b'S'*4+bytes(12))
+        self.assertEqual(content[16:32],b'L'*16)
+        image=DiskImage(self.filename,self.geometry)
+        image.write_track(0,b'F'*16)
+        self.assertEqual(image.close(),[2,3])
+
+    @mock.patch('cpm_diskimage.logger')
+    def test_reuse(self,mock_logger):
+        """Test an existing image keeps its content and knows the tracks received
+        """
+        image=DiskImage(self.filename,self.geometry)
+        image.write_track(3,b'D'*16)
+        image.close()
+        image=DiskImage(self.filename,self.geometry)
+        self.assertEqual(image.missing_tracks(),[0,1,2])
+        image.write_track(1,b'B'*16)
+        image.flush()
+        interrupted=image
+        image=DiskImage(self.filename,self.geometry)
+        self.assertEqual(image.missing_tracks(),[0,2])
+        image.close()
+        interrupted.close()
+        with open(self.filename,"rb") as img:
+            self.assertEqual(img.read()[48:],b'D'*16)
+        os.unlink(self.filename+".info")
+        image=DiskImage(self.filename,self.geometry)
+        self.assertEqual(image.missing_tracks(),[0,1,2,3])
+        image.close()
+        mock_logger.info.assert_called()
+        mock_logger.warning.assert_called()
+
+    @mock.patch('cpm_diskimage.logger')
+    def test_reuse_other_geometry(self,mock_logger):
+        """Test the tracks received are not taken over for another geometry
+        """
+        image=DiskImage(self.filename,self.geometry)
+        image.write_track(0,b'A'*16)
+        image.close()
+        image=DiskImage(self.filename,DiskGeometry("other",2,4,8))
+        self.assertEqual(image.missing_tracks(),[0,1])
+        image.close()
+        mock_logger.warning.assert_called()
+
+    @mock.patch('cpm_diskimage.logger')
+    def test_wrong_size(self,mock_logger):
+        """Test an existing file of another size is refused and left untouched
+        """
+        with open(self.filename,"wb") as img:
+            img.write(b'Z'*100)
+        self.assertRaises(ValueError,DiskImage,self.filename,self.geometry)
+        with open(self.filename,"rb") as img:
+            self.assertEqual(img.read(),b'Z'*100)
+        with open(self.filename,"wb"):
+            pass
+        DiskImage(self.filename,self.geometry).close()
+        self.assertEqual(os.path.getsize(self.filename),64)
+        mock_logger.info.assert_called()
@@ -15,12 +15,20 @@ Code
 ####
 """
 
+import os
+import json
+import tempfile
 import unittest
+import threading
 import argparse
+from pathlib import Path
 from unittest.mock import MagicMock, mock_open
 from unittest import mock
 import pytest
-from cpm_downloader import Command,main
+import cpm_dirlistcompare
+from cpm_batchwriter import BatchWriter
+from cpm_downloader import Command,FrameReader,FrameTimeout,Receiver,line_timeouts,main,\
+    decode_line_errors,enable_error_marking
 
 class TestDownloader(unittest.TestCase):
     '''
@@ -217,9 +225,456 @@ class TestDownloader(unittest.TestCase):
         mock_logger.exception.assert_called_once()
         mock_logger.info.assert_called()
         mock_logger.error.assert_not_called()
+        #output path and quarantine folder
+        self.assertEqual(mock_path.return_value.mkdir.call_count,2)
+
+
+    @mock.patch('cpm_downloader.DiskImage')
+    @mock.patch('cpm_downloader.serial')
+    @mock.patch('playsound.playsound')
+    @mock.patch('cpm_downloader.logger')
+    @mock.patch('cpm_downloader.Path')
+    def test_serial_read_track(self,mock_path, mock_logger,mock_sound,mock_ser,mock_image):
+        """Test with open serial device: read tracks into an image and quit
+        """
+        ser_line=MagicMock()
+        ser_line.is_open=True
+        ser_line.read_until=MagicMock(side_effect=[b'Track>>>+++STOP+++<<<',\
+            b'T001.TRK<<<+++GO+++>>>',b'>>>+++STOP+++<<<',b'QUIT<<<+++GO+++>>>'])
+        serial=MagicMock()
+        serial.return_value.__enter__.return_value=ser_line
+        serial.return_value.__exit__.return_value=MagicMock()
+        mock_ser.Serial=serial
+        options = self.parser.parse_args(["--image","disk.img","--geometry","5dsdd"])
+        with mock.patch('builtins.open', mock_open()) as mymock_open:
+            self.start_handler(options)
+        mymock_open.assert_not_called()
+        mock_image.return_value.write_track.assert_called_once_with(1,b'Track')
+        mock_image.return_value.close.assert_called_once()
+        mock_sound.assert_called_once()
+        mock_logger.exception.assert_not_called()
+        mock_path.return_value.mkdir.assert_called()
+
+    @mock.patch('playsound.playsound')
+    @mock.patch('cpm_downloader.logger')
+    @mock.patch('cpm_downloader.Path')
+    def test_image_invalid_geometry(self,mock_path, mock_logger,mock_sound):
+        """Test an image with unknown geometry, terminates before opening the line
+        """
+        options = self.parser.parse_args(["--image","disk.img","--geometry","xx"])
+        self.start_handler(options)
+        mock_sound.assert_not_called()
+        mock_logger.exception.assert_called_once()
+        mock_path.return_value.mkdir.assert_called_once()
+
+
+    @mock.patch('cpm_downloader.serial')
+    @mock.patch('playsound.playsound')
+    @mock.patch('cpm_downloader.logger')
+    def test_replay(self,mock_logger,mock_sound,mock_ser):
+        """Test a replayed capture: change dir, save and end of stream without quit
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            capture=os.path.join(tmpdir,"test.cap")
+            with open(capture,"wb") as cap:
+                cap.write(b'>>>+++STOP+++<<<#_G01<<<+++GO+++>>>'\
+                    b'My\xff\x00Data>>>+++STOP+++<<<File1.txt<<<+++GO+++>>>')
+            options = self.parser.parse_args(["--replay",capture,"--path",tmpdir])
+            #a capture without sidecar contains raw bytes, no marks
+            self.start_handler(options)
+            with open(os.path.join(tmpdir,"g01","file1.txt"),"rb") as stored:
+                self.assertEqual(stored.read(),b'My\xff\x00Data')
+        mock_ser.Serial.assert_not_called()
+        mock_sound.assert_called_once()
+        mock_logger.exception.assert_not_called()
+
+    @mock.patch('cpm_downloader.CaptureRecorder')
+    @mock.patch('cpm_downloader.serial')
+    @mock.patch('playsound.playsound')
+    @mock.patch('cpm_downloader.logger')
+    @mock.patch('cpm_downloader.Path')
+    def test_record(self,mock_path,mock_logger,mock_sound,mock_ser,mock_recorder):
+        """Test the serial line is read through the recorder
+        """
+        ser_line=MagicMock()
+        ser_line.is_open=True
+        serial=MagicMock()
+        serial.return_value.__enter__.return_value=ser_line
+        mock_ser.Serial=serial
+        recorder=mock_recorder.return_value
+        recorder.read_until=MagicMock(side_effect=[b'>>>+++STOP+++<<<',b'QUIT<<<+++GO+++>>>'])
+        options = self.parser.parse_args(["--record","."])
+        self.start_handler(options)
+        mock_recorder.assert_called_once()
+        self.assertEqual(mock_recorder.call_args[0][0],ser_line)
+        ser_line.read_until.assert_not_called()
+        mock_sound.assert_called_once()
+        mock_logger.exception.assert_not_called()
+        mock_path.assert_any_call(".")
+        self.assertEqual(mock_path.return_value.mkdir.call_count,2)
+
+    @mock.patch('cpm_downloader.serial')
+    @mock.patch('playsound.playsound')
+    @mock.patch('cpm_downloader.logger')
+    def test_record_failed(self,mock_logger,mock_sound,mock_ser):
+        """Test the record folder is created and capture errors are not serial errors
+        """
+        ser_line=MagicMock()
+        ser_line.is_open=True
+        mock_ser.Serial.return_value.__enter__.return_value=ser_line
+        mock_ser.SerialException=OSError
+        with tempfile.TemporaryDirectory() as tmpdir:
+            folder=os.path.join(tmpdir,"captures")
+            with mock.patch('cpm_downloader.CaptureRecorder',side_effect=OSError("disk full")):
+                options=self.parser.parse_args(["--record",folder,"--path",tmpdir])
+                self.start_handler(options)
+            self.assertTrue(os.path.isdir(folder))
+        mock_logger.exception.assert_called_once()
+        self.assertIn("capture",mock_logger.exception.call_args[0][0])
+        ser_line.read_until.assert_not_called()
+        mock_sound.assert_called_once()
+
+
+    def test_line_timeouts(self):
+        """Test the timeouts derived from the baudrate
+        """
+        self.assertEqual(line_timeouts(19200),(0.5,60.0))
+        read_timeout,frame_timeout=line_timeouts(300)
+        self.assertAlmostEqual(read_timeout,32/30)
+        self.assertAlmostEqual(frame_timeout,4096/30)
+        self.assertEqual(line_timeouts(300,2.0,0),(2.0,0))
+
+    @mock.patch('cpm_downloader.time')
+    def test_frame_reader(self,mock_time):
+        """Test frames split over several reads, idle reads and housekeeping
+        """
+        mock_time.monotonic=MagicMock(side_effect=[0.0,0.0,1.0,2.0,3.0,70.0,71.0,72.0])
+        line=MagicMock()
+        line.read_until=MagicMock(side_effect=[b'Data>>S',b'',b'TOP<<Name',b'',b'GO'])
+        housekeeping=MagicMock()
+        reader=FrameReader(line,frame_timeout=0,housekeeping=housekeeping)
+        self.assertEqual(reader.read_frame(b'>>STOP<<'),b'Data')
+        self.assertEqual(reader.pending,4)
+        self.assertEqual(reader.read_frame(b'GO'),b'Name')
+        self.assertEqual(reader.frames,2)
+        self.assertEqual(reader.received,18)
+        self.assertEqual(reader.longest_gap,2.0)
+        housekeeping.assert_called_once()
+
+    @mock.patch('cpm_downloader.time')
+    def test_frame_reader_stall(self,mock_time):
+        """Test a frame stalling longer than the frame timeout
+        """
+        mock_time.monotonic=MagicMock(side_effect=[0.0,0.0,1.0,30.0,62.0])
+        line=MagicMock()
+        line.read_until=MagicMock(side_effect=[b'Part',b'',b''])
+        reader=FrameReader(line,frame_timeout=60)
+        with self.assertRaises(FrameTimeout) as context:
+            reader.read_frame(b'>>STOP<<')
+        self.assertEqual(context.exception.partial,b'Part')
+        self.assertEqual(reader.stalls,1)
+        self.assertEqual(reader.pending,0)
+
+    @mock.patch('cpm_downloader.logger')
+    def test_receiver_quarantine(self,mock_logger):
+        """Test a stalled frame is quarantined and the session continues
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            receiver=Receiver(tmpdir,frame_timeout=60)
+            with mock.patch('cpm_downloader.FrameReader.read_frame',
+                            side_effect=[b'Data',FrameTimeout(b'Na'),b'',b'QUIT']):
+                receiver.receive(MagicMock())
+            folder=os.path.join(tmpdir,Receiver.quarantine_folder)
+            names=os.listdir(folder)
+            self.assertEqual(len(names),2)
+            names.sort()
+            with open(os.path.join(folder,names[0]),"rb") as partial:
+                self.assertEqual(partial.read(),b'Data'+Receiver.stop_sep+b'Na')
+            self.assertEqual(names[1],names[0]+".report")
+        self.assertEqual(receiver.quarantined,1)
+        mock_logger.warning.assert_called()
+
+    @mock.patch('cpm_downloader.logger')
+    def test_receiver_after_stall(self,mock_logger):
+        """Test the frame completing a stalled one is quarantined, not stored
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            receiver=Receiver(tmpdir,frame_timeout=60)
+            with mock.patch('cpm_downloader.FrameReader.read_frame',
+                            side_effect=[FrameTimeout(b'FIRSTHALF-'),b'SECONDHALF',
+                                         b'IMPORTANT.COM',b'Next',b'OTHER.COM',b'',b'QUIT']):
+                receiver.receive(MagicMock())
+            self.assertEqual(sorted(os.listdir(tmpdir)),[Receiver.quarantine_folder,"other.com"])
+            folder=os.path.join(tmpdir,Receiver.quarantine_folder)
+            reports=sorted(name for name in os.listdir(folder) if name.endswith(".report"))
+            with open(os.path.join(folder,reports[1]),"r",encoding='utf-8') as report_file:
+                report=json.load(report_file)
+            with open(os.path.join(folder,reports[1][:-len(".report")]),"rb") as rest:
+                self.assertEqual(rest.read(),b'SECONDHALF')
+        self.assertEqual(report["file"],"important.com")
+        self.assertIn("follows a stall",report["reason"])
+        self.assertEqual(receiver.quarantined,2)
+        self.assertEqual(receiver.files,1)
+        mock_logger.warning.assert_called()
+
+
+    def test_decode_line_errors(self):
+        """Test removing the PARMRK marks
+        """
+        self.assertEqual(decode_line_errors(b'plain'),(b'plain',0))
+        self.assertEqual(decode_line_errors(b'a\xff\xffb'),(b'a\xffb',0))
+        self.assertEqual(decode_line_errors(b'a\xff\x00xb'),(b'axb',1))
+        self.assertEqual(decode_line_errors(b'a\xff\x00\x00b\xff\x00'),(b'ab',2))
+
+    @mock.patch('cpm_downloader.termios')
+    def test_enable_error_marking(self,mock_termios):
+        """Test the termios flags for error marking
+        """
+        mock_termios.INPCK=1
+        mock_termios.PARMRK=2
+        mock_termios.IGNPAR=4
+        mock_termios.ISTRIP=8
+        mock_termios.IGNBRK=16
+        mock_termios.BRKINT=32
+        mock_termios.error=OSError
+        mock_termios.tcgetattr=MagicMock(return_value=[4+8+64,0,0,0,0,0,[]])
+        ser=MagicMock()
+        self.assertTrue(enable_error_marking(ser))
+        self.assertEqual(mock_termios.tcsetattr.call_args[0][2][0],1+2+64)
+        mock_termios.tcgetattr.side_effect=OSError
+        self.assertFalse(enable_error_marking(ser))
+
+    @mock.patch('playsound.playsound')
+    @mock.patch('cpm_downloader.logger')
+    def test_receiver_line_errors(self,mock_logger,mock_sound):
+        """Test a file with line errors is quarantined with report, the session continues
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            receiver=Receiver(tmpdir)
+            receiver.error_marking=True
+            line=MagicMock()
+            line.read_until=MagicMock(side_effect=[b'Bad\xff\x00Data>>>+++STOP+++<<<',\
+                b'File1.txt<<<+++GO+++>>>',b'Good\xff\xff>>>+++STOP+++<<<',\
+                b'File2.txt<<<+++GO+++>>>',b'>>>+++STOP+++<<<',b'QUIT<<<+++GO+++>>>'])
+            receiver.receive(line)
+            with open(os.path.join(tmpdir,"file2.txt"),"rb") as stored:
+                self.assertEqual(stored.read(),b'Good\xff')
+            self.assertFalse(os.path.exists(os.path.join(tmpdir,"file1.txt")))
+            folder=os.path.join(tmpdir,Receiver.quarantine_folder)
+            names=sorted(os.listdir(folder))
+            self.assertTrue(names[0].endswith("file1.txt"))
+            with open(os.path.join(folder,names[0]),"rb") as stored:
+                self.assertEqual(stored.read(),b'BadData')
+            with open(os.path.join(folder,names[1]),"r",encoding='utf-8') as report:
+                self.assertEqual(json.load(report)["line_errors"],1)
+        self.assertEqual(receiver.line_errors,1)
+        mock_sound.assert_called_once()
+        mock_logger.warning.assert_called()
+
+    @mock.patch('playsound.playsound')
+    @mock.patch('cpm_downloader.logger')
+    def test_receiver_write_error(self,mock_logger,mock_sound):
+        """Test a file that could not be written does not end the session
+        """
+        with tempfile.NamedTemporaryFile() as no_folder:
+            #a file as output path, writing below it fails even for root
+            receiver=Receiver(no_folder.name)
+            line=MagicMock()
+            line.read_until=MagicMock(side_effect=[b'Data>>>+++STOP+++<<<',\
+                b'File1.txt<<<+++GO+++>>>',b'Data>>>+++STOP+++<<<',\
+                b'File2.txt<<<+++GO+++>>>',b'>>>+++STOP+++<<<',b'QUIT<<<+++GO+++>>>'])
+            receiver.receive(line)
+        self.assertEqual(receiver.failed,2)
+        #the quarantine can not be written either
+        self.assertEqual(mock_logger.exception.call_count,4)
+        self.assertEqual(mock_sound.call_count,2)
+
+    @mock.patch('playsound.playsound')
+    @mock.patch('cpm_downloader.logger')
+    def test_receiver_write_error_quarantined(self,mock_logger,mock_sound):
+        """Test the bytes of a file that could not be written are quarantined
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.mkdir(os.path.join(tmpdir,"file1.txt"))
+            receiver=Receiver(tmpdir)
+            line=MagicMock()
+            line.read_until=MagicMock(side_effect=[b'Data>>>+++STOP+++<<<',\
+                b'File1.txt<<<+++GO+++>>>',b'>>>+++STOP+++<<<',b'QUIT<<<+++GO+++>>>'])
+            receiver.receive(line)
+            folder=os.path.join(tmpdir,Receiver.quarantine_folder)
+            names=sorted(os.listdir(folder))
+            with open(os.path.join(folder,names[0]),"rb") as stored:
+                self.assertEqual(stored.read(),b'Data')
+            with open(os.path.join(folder,names[1]),"r",encoding='utf-8') as report:
+                self.assertIn("could not be written",json.load(report)["reason"])
+        self.assertEqual(receiver.failed,1)
+        self.assertEqual(receiver.quarantined,1)
+        mock_logger.exception.assert_called_once()
+        mock_sound.assert_called_once()
+
+
+    def test_frame_reader_sink(self):
+        """Test the sink gets the frame without separator while it arrives
+        """
+        line=MagicMock()
+        line.read_until=MagicMock(side_effect=[b'Dir listing>>S',b'TOP<<next'])
+        sink=MagicMock()
+        reader=FrameReader(line)
+        self.assertEqual(reader.read_frame(b'>>STOP<<',sink),b'Dir listing')
+        self.assertEqual(b''.join(call[0][0] for call in sink.call_args_list),b'Dir listing')
+        self.assertEqual(sink.call_args_list[0][0][0],b'Dir lis')
+
+    @mock.patch('cpm_downloader.logger')
+    def test_receiver_listing(self,mock_logger):
+        """Test a listing announced with #!dir is tracked, received files are no longer missing
+        """
+        listing=b'Directory For Drive G:  User  1\r\n\r\n'\
+            b'------------ ------ ------ ------------ ------------ ------ ------ ------------\r\n'\
+            b'ALLFILES LST     0k      0 Dir RW       CCP      COM     4k     25 Sys RW      \r\n'\
+            b'\r\n'
+        with tempfile.TemporaryDirectory() as tmpdir:
+            receiver=Receiver(tmpdir)
+            receiver.tracker=cpm_dirlistcompare.MissingTracker()
+            line=MagicMock()
+            line.read_until=MagicMock(side_effect=[b'>>>+++STOP+++<<<',b'#!dir<<<+++GO+++>>>',
+                listing[0:40],listing[40:]+b'>>>+++STOP+++<<<',b'LIST.LST<<<+++GO+++>>>',
+                b'>>>+++STOP+++<<<',b'#_G01<<<+++GO+++>>>',
+                b'Data>>>+++STOP+++<<<',b'CCP.COM<<<+++GO+++>>>',
+                b'>>>+++STOP+++<<<',b'QUIT<<<+++GO+++>>>'])
+            receiver.receive(line)
+            self.assertTrue(os.path.exists(os.path.join(tmpdir,"list.lst")))
+        self.assertEqual(receiver.tracker.listed,2)
+        self.assertEqual(receiver.tracker.missing,{"G01_ALLFILES.LST"})
+        mock_logger.info.assert_any_call("%d files still missing: %s",1,"G01_ALLFILES.LST")
+
+    @mock.patch('cpm_downloader.logger')
+    def test_receiver_listing_by_name(self,mock_logger):
+        """Test a file named *.lst is parsed as listing after it has been received
+        """
+        listing=b'Directory For Drive F:  User  0\n'\
+            b'------------ ------ ------ ------------ ------------ ------ ------ ------------\n'\
+            b'ALLFILES LST     0k      0 Dir RW       CCP      COM     4k     25 Sys RW      '
+        with tempfile.TemporaryDirectory() as tmpdir:
+            receiver=Receiver(tmpdir)
+            receiver.tracker=cpm_dirlistcompare.MissingTracker(["F00_CCP.COM"])
+            receiver.process(listing,"list.lst")
+        self.assertEqual(receiver.tracker.missing,{"F00_ALLFILES.LST"})
+        mock_logger.info.assert_called()
+
+
+    @mock.patch('cpm_downloader.serial')
+    @mock.patch('playsound.playsound')
+    @mock.patch('cpm_downloader.logger')
+    @mock.patch('cpm_downloader.Path')
+    def test_reference_failed(self,mock_path,mock_logger,mock_sound,mock_ser):
+        """Test a reference listing that could not be read, terminates before opening the line
+        """
+        options = self.parser.parse_args(["--reference","/nonexisting/list.lst"])
+        with mock.patch('cpm_dirlistcompare.logger'):
+            self.start_handler(options)
+        mock_logger.error.assert_called_once()
+        mock_ser.Serial.assert_not_called()
+        mock_sound.assert_not_called()
         mock_path.return_value.mkdir.assert_called_once()
 
 
+    @mock.patch('cpm_batchwriter.logger')
+    @mock.patch('cpm_downloader.logger')
+    def test_receiver_batched(self,mock_logger,mock_batch_logger):
+        """Test files are written by the batch writer, committed at the end of the session
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            receiver=Receiver(tmpdir)
+            receiver.writer=BatchWriter(staging=os.path.join(tmpdir,"staging"))
+            line=MagicMock()
+            line.read_until=MagicMock(side_effect=[b'>>>+++STOP+++<<<',b'#_g01<<<+++GO+++>>>',
+                b'Data>>>+++STOP+++<<<',b'FILE1.TXT<<<+++GO+++>>>',
+                b'>>>+++STOP+++<<<',b'#_g01<<<+++GO+++>>>',
+                b'>>>+++STOP+++<<<',b'QUIT<<<+++GO+++>>>'])
+            with mock.patch('cpm_batchwriter.Path',wraps=Path) as mock_path:
+                receiver.receive(line)
+                receiver.writer.close()
+            mock_path.assert_called_once_with(os.path.join(tmpdir,"g01"))
+            with open(os.path.join(tmpdir,"g01","file1.txt"),"rb") as bin_file:
+                self.assertEqual(bin_file.read(),b'Data')
+        self.assertEqual(receiver.writer.committed,1)
+        self.assertEqual(receiver.files,1)
+        self.assertEqual(receiver.failed,0)
+        mock_logger.info.assert_called()
+        mock_batch_logger.info.assert_called_once()
+
+    @mock.patch('cpm_batchwriter.logger')
+    @mock.patch('cpm_downloader.logger')
+    def test_receiver_batch_idle(self,mock_logger,mock_batch_logger):
+        """Test a batch is committed by the housekeeping while the line is idle
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            receiver=Receiver(tmpdir)
+            receiver.writer=BatchWriter(batch_interval=0.02,staging=os.path.join(tmpdir,"st"))
+            target=os.path.join(tmpdir,"file1.txt")
+            arrived=[]
+            def idle(*args): #pylint: disable=unused-argument
+                threading.Event().wait(0.02)
+                arrived.append(os.path.exists(target))
+                return b''
+            #three idle reads, None, between file and quit
+            responses=iter([b'Data>>>+++STOP+++<<<',b'FILE1.TXT<<<+++GO+++>>>',
+                None,None,None,b'>>>+++STOP+++<<<',b'QUIT<<<+++GO+++>>>'])
+            def read_until(*args): #pylint: disable=unused-argument
+                response=next(responses)
+                return idle() if response is None else response
+            line=MagicMock()
+            line.read_until=MagicMock(side_effect=read_until)
+            receiver.receive(line)
+            receiver.writer.close()
+        self.assertTrue(arrived[-1])
+        self.assertEqual(receiver.writer.batches,1)
+        mock_logger.info.assert_called()
+        mock_batch_logger.info.assert_called_once()
+
+    @mock.patch('cpm_daemon.run_daemon')
+    @mock.patch('playsound.playsound')
+    @mock.patch('cpm_downloader.logger')
+    @mock.patch('cpm_downloader.Path')
+    def test_daemon(self,mock_path,mock_logger,mock_sound,mock_run):
+        """Test daemon mode serves every device in a subfolder of its own
+        """
+        options = self.parser.parse_args(["--daemon","/tmp/cpm.sock","--path","out",
+                                          "--device","/dev/ttyS0, /dev/ttyS1"])
+        self.start_handler(options)
+        workers=mock_run.call_args[0][1]
+        self.assertEqual(mock_run.call_args[0][0],"/tmp/cpm.sock")
+        self.assertEqual([worker.file_path for worker in workers],
+                         [os.path.join("out","ttyS0"),os.path.join("out","ttyS1")])
+        self.assertEqual(workers[1].device,"/dev/ttyS1")
+        mock_sound.assert_not_called()
+        mock_run.reset_mock()
+        options = self.parser.parse_args(["--daemon","/tmp/cpm.sock","--image","disk.img"])
+        self.start_handler(options)
+        mock_run.assert_not_called()
+        mock_logger.error.assert_called_once()
+        mock_path.return_value.mkdir.assert_called()
+
+    def test_batch_options(self):
+        """Test the batch writer arguments, syncing is off unless asked for
+        """
+        self.assertIsNone(Command.batch_options(vars(self.parser.parse_args([]))))
+        options=vars(self.parser.parse_args(["--batch","10"]))
+        self.assertEqual(Command.batch_options(options),
+                         {"batch_size":10,"batch_interval":5.0,"staging":None,"sync":False})
+        options=vars(self.parser.parse_args(["--staging","st","--batch_sync"]))
+        self.assertTrue(Command.batch_options(options)["sync"])
+        self.assertEqual(Command.batch_options(options)["staging"],"st")
+
+    def test_profile_conflict(self):
+        """Test profiling is refused in daemon mode only
+        """
+        options=vars(self.parser.parse_args(["--daemon","/tmp/cpm.sock","--profile","sample"]))
+        self.assertIn("daemon",Command.profile_conflict(options))
+        options=vars(self.parser.parse_args(["--profile","sample"]))
+        self.assertIsNone(Command.profile_conflict(options))
+
+
     @mock.patch('cpm_downloader.Command')
     @mock.patch('cpm_downloader.cmdline_main')
     def test_main(self,mock_main,mock_cmd):
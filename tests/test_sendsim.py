@@ -0,0 +1,186 @@
+"""
+**Unit tests for the sender simulator**
+
+Content
+#######
+This module tests to some extend the provided functionalities
+
+Info
+####
+* **author:** (c) Thomas Lüth 2024
+* **email:** info@tlc-it-consulting.com
+* **created:** 2024-03-11
+
+Code
+####
+"""
+
+import os
+import tty
+import json
+import random
+import tempfile
+import unittest
+import argparse
+import threading
+import subprocess
+from unittest import mock
+from cpm_downloader import decode_line_errors
+from cpm_capture import capture_marked
+from cpm_sendsim import Command, SenderSimulator, LineErrorInjector, session_frames,\
+    format_report, input_queue
+
+class TestSendSim(unittest.TestCase):
+    '''
+    Testing the sender simulator
+    '''
+
+    def setUp(self):
+        self.master,self.slave=os.openpty()
+        tty.setraw(self.slave)
+
+    def tearDown(self):
+        os.close(self.master)
+        os.close(self.slave)
+
+    def read_all(self, count, received):
+        """Read count bytes from the slave side, like a receiver would
+
+        Args:
+            count (int): Bytes expected
+            received (bytearray): Gets the bytes read
+        """
+        while len(received)<count:
+            received+=os.read(self.slave,4096)
+
+    def test_session_frames(self):
+        """Test the frames follow the STOP/GO protocol and end with quit
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename=os.path.join(tmpdir,"test.com")
+            with open(filename,"wb") as test_file:
+                test_file.write(b'Data')
+            frames=list(session_frames([filename],"g01"))
+        self.assertEqual(frames,[b'>>>+++STOP+++<<<#_g01<<<+++GO+++>>>',
+                                 b'Data>>>+++STOP+++<<<TEST.COM<<<+++GO+++>>>',
+                                 b'>>>+++STOP+++<<<QUIT<<<+++GO+++>>>'])
+
+    def test_injector(self):
+        """Test flipped bits and error marks the receiver decodes
+        """
+        data=bytes(range(256))*4
+        injector=LineErrorInjector(0.01,"flip",random.Random(1))
+        damaged=injector.apply(data)
+        self.assertEqual(len(damaged),len(data))
+        self.assertEqual(sum(a!=b for a,b in zip(data,damaged)),injector.injected)
+        self.assertGreater(injector.injected,0)
+        data=bytes(range(1,256))*4
+        injector=LineErrorInjector(0.01,"mark",random.Random(1))
+        decoded,errors=decode_line_errors(injector.apply(data))
+        self.assertEqual(decoded,data)
+        self.assertEqual(errors,injector.injected)
+        self.assertEqual(LineErrorInjector().apply(b'\xff'),b'\xff')
+
+    def test_paced(self):
+        """Test the bytes arrive completely, paced at the baudrate
+        """
+        data=os.urandom(2000)
+        received=bytearray()
+        reader=threading.Thread(target=self.read_all,args=(len(data),received))
+        reader.start()
+        simulator=SenderSimulator(self.master,self.slave,100000,jitter=0.001)
+        simulator.send(data)
+        reader.join(10)
+        self.assertEqual(bytes(received),data)
+        report=simulator.report()
+        self.assertEqual(report["sent"],2000)
+        self.assertEqual(report["overruns"],0)
+        self.assertGreaterEqual(report["elapsed"],0.19)
+        self.assertLessEqual(report["efficiency"],101)
+
+    def test_cts(self):
+        """Test the sender waits while the receiver does not read
+        """
+        data=os.urandom(3000)
+        simulator=SenderSimulator(self.master,self.slave,0,rx_buffer=1000)
+        received=bytearray()
+        reader=threading.Timer(0.2,self.read_all,args=(len(data),received))
+        reader.start()
+        simulator.send(data)
+        reader.join(10)
+        self.assertEqual(bytes(received),data)
+        report=simulator.report()
+        self.assertGreaterEqual(report["stalls"],1)
+        self.assertGreater(report["longest_stall"],0.1)
+        self.assertEqual(report["high_water"],1000)
+        self.assertIn("Receiver stalls (CTS low): ",format_report(dict(report,errors_injected=0)))
+
+    def test_no_cts(self):
+        """Test bytes not fitting into the receive buffer are lost without flow control
+        """
+        simulator=SenderSimulator(self.master,self.slave,0,rx_buffer=1000,honor_cts=False)
+        simulator.send(b'x'*3000)
+        self.assertEqual(simulator.sent,1000)
+        self.assertEqual(simulator.overruns,2000)
+        self.assertEqual(input_queue(self.slave),1000)
+        self.assertEqual(simulator.stalls,0)
+
+    def test_max_stall(self):
+        """Test the sender gives up if the receiver never reads
+        """
+        simulator=SenderSimulator(self.master,self.slave,0,rx_buffer=100,max_stall=0.05)
+        self.assertRaises(TimeoutError,simulator.send,b'x'*200)
+
+    @mock.patch('cpm_sendsim.logger')
+    @mock.patch('builtins.print')
+    def test_handler_capture(self,mock_print,mock_logger):
+        """Test a session with error marks written into a capture file
+        """
+        parser=argparse.ArgumentParser(description=Command.help)
+        Command.add_arguments(parser)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with open(os.path.join(tmpdir,"a.txt"),"wb") as test_file:
+                test_file.write(b'\xff'*100)
+            capture=os.path.join(tmpdir,"session.cap")
+            options=parser.parse_args(["--files",tmpdir,"--error_rate","0.05","--error_mode",
+                                       "mark","--seed","3","--capture",capture,"--format",
+                                       "json"])
+            Command.handle(**vars(options))
+            with open(capture,"rb") as capture_file:
+                decoded,errors=decode_line_errors(capture_file.read())
+            self.assertTrue(capture_marked(capture))
+        report=json.loads(mock_print.call_args[0][0])
+        self.assertEqual(errors,report["errors_injected"])
+        self.assertTrue(decoded.startswith(b'\xff'*100+b'>>>+++STOP+++<<<A.TXT'))
+        options=parser.parse_args(["--files",tmpdir,"--error_mode","mark"])
+        Command.handle(**vars(options))
+        mock_logger.error.assert_called_once()
+
+    @mock.patch('cpm_sendsim.logger')
+    @mock.patch('builtins.print')
+    def test_handler_stalled(self,mock_print,mock_logger):
+        """Test a receiver that never reads: the session is aborted after --max_stall,
+        reported and the receiver is stopped
+        """
+        parser=argparse.ArgumentParser(description=Command.help)
+        Command.add_arguments(parser)
+        started=[]
+        def popen(*args, **kwargs):
+            started.append(subprocess.Popen(*args, **kwargs)) #pylint: disable=consider-using-with
+            return started[-1]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with open(os.path.join(tmpdir,"a.com"),"wb") as test_file:
+                test_file.write(b'x'*3000)
+            options=parser.parse_args(["--files",tmpdir,"--baud","0","--rx_buffer","1000",
+                                       "--run","sleep 30","--startup","0","--max_stall","0.2",
+                                       "--format","json"])
+            with mock.patch('cpm_sendsim.subprocess.Popen',side_effect=popen):
+                Command.handle(**vars(options))
+        report=json.loads(mock_print.call_args[0][0])
+        self.assertIn("did not read",report["aborted"])
+        self.assertEqual(report["sent"],1000)
+        self.assertGreaterEqual(report["longest_stall"],0.2)
+        self.assertIsNotNone(started[0].returncode)
+        mock_logger.warning.assert_called_once()
+        mock_logger.exception.assert_not_called()
+        self.assertIn("Session aborted: ",format_report(report))
@@ -15,17 +15,27 @@ Code
 ####
 """
 
+import os
+import queue
+import atexit
+import threading
+import logging as real_logging
+import argparse
+import tempfile
 import unittest
 from unittest.mock import MagicMock
 from unittest import mock
 # import pytest
-from tlu_utils import get_git_version, add_parser_log_args, cmdline_main,configure_logging
+from tlu_utils import get_git_version, add_parser_log_args, cmdline_main,configure_logging,\
+    get_build_version, lazy_import, span, enable_spans, span_summary, run_profiled, NULL_SPAN,\
+    SPAN_TIMES, SamplingProfiler, RepeatFilter
 
 class TestUtils(unittest.TestCase):
     '''
     Testing the utils functions
     '''
 
+    @mock.patch('tlu_utils.VERSION_FILE','/nonexisting/VERSION')
     @mock.patch('tlu_utils.run')
     def test_version(self,mock_run):
         """Test git version
@@ -40,6 +50,7 @@ class TestUtils(unittest.TestCase):
         self.assertEqual(git_version,"1.2.3")
         mock_run.assert_called_once()
 
+    @mock.patch('tlu_utils.VERSION_FILE','/nonexisting/VERSION')
     @mock.patch('tlu_utils.run')
     def test_version_err(self,mock_run):
         """Test git version
@@ -55,6 +66,38 @@ class TestUtils(unittest.TestCase):
         mock_run.assert_called_once()
         process.stdout.decode.assert_not_called()
 
+    @mock.patch('tlu_utils.VERSION_FILE','/nonexisting/VERSION')
+    @mock.patch('tlu_utils.run')
+    def test_version_no_git(self,mock_run):
+        """Test git version
+        Call get_git_version without git installed
+        """
+        mock_run.side_effect=FileNotFoundError
+        self.assertEqual(get_git_version(),"")
+
+    @mock.patch('tlu_utils.run')
+    def test_version_build(self,mock_run):
+        """Test the version baked in at packaging time, git is not called
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            version_file=os.path.join(tmpdir,"VERSION")
+            with open(version_file,"w",encoding='utf-8') as version:
+                version.write("1.0.1-3-gabcdef0\n")
+            with mock.patch('tlu_utils.VERSION_FILE',version_file):
+                self.assertEqual(get_build_version(),"1.0.1-3-gabcdef0")
+                self.assertEqual(get_git_version(),"1.0.1-3-gabcdef0")
+        mock_run.assert_not_called()
+
+    @mock.patch('tlu_utils.importlib')
+    def test_lazy_import(self,mock_importlib):
+        """Test the module is imported on first use only
+        """
+        module=lazy_import("any_module")
+        mock_importlib.import_module.assert_not_called()
+        self.assertEqual(module.attr,mock_importlib.import_module.return_value.attr)
+        module.other()
+        mock_importlib.import_module.assert_called_once_with("any_module")
+
     def test_add_parser(self):
         """Test to add some lines to a parser
         """
@@ -112,3 +155,181 @@ class TestUtils(unittest.TestCase):
         logging.basicConfig.assert_called_once()
         console.setFormatter.assert_called_with(formatter)
         logger.addHandler.assert_called_with(console)
+
+    def test_config_logging_queue(self):
+        """Test the handlers are moved behind a queue served by a listener
+        """
+        logging=MagicMock()
+        root=real_logging.Logger("test_queue")
+        records=queue.SimpleQueue()
+        handler=real_logging.Handler()
+        handler.emit=records.put
+        root.addHandler(handler)
+        logging.getLogger=MagicMock(return_value=root)
+        listener=configure_logging(False,logging,"test.log",10,use_queue=True,repeat_interval=60)
+        try:
+            self.assertEqual(len(root.handlers),1)
+            self.assertNotIn(handler,root.handlers)
+            self.assertIsNone(configure_logging(False,logging,"test.log",10,use_queue=True))
+            for _ in range(3):
+                root.info("%d Bytes",10)
+            record=records.get(timeout=5)
+        finally:
+            atexit.unregister(listener.stop)
+            listener.stop()
+        self.assertEqual(record.getMessage(),"10 Bytes")
+        self.assertTrue(records.empty())
+
+    def test_repeat_filter(self):
+        """Test identical messages are suppressed within the interval
+        """
+        repeat_filter=RepeatFilter(10)
+        def record(created,args=(1,)):
+            log_record=real_logging.LogRecord("test",20,"test.py",1,"value %d",args,None)
+            log_record.created=created
+            return log_record
+        self.assertTrue(repeat_filter.filter(record(100)))
+        self.assertFalse(repeat_filter.filter(record(105)))
+        self.assertFalse(repeat_filter.filter(record(106)))
+        self.assertTrue(repeat_filter.filter(record(106,(2,))))
+        repeated=record(111)
+        self.assertTrue(repeat_filter.filter(repeated))
+        self.assertEqual(repeated.getMessage(),"value 1 (2 repeats suppressed)")
+        #a second handler gets the same decision and message
+        self.assertTrue(repeat_filter.filter(repeated))
+        self.assertEqual(repeated.getMessage(),"value 1 (2 repeats suppressed)")
+        self.assertTrue(repeat_filter.filter(record(112,([1],))))
+
+    def test_repeat_filter_pruned(self):
+        """Test messages not seen for an interval are forgotten
+        """
+        repeat_filter=RepeatFilter(10)
+        for number in range(1000):
+            log_record=real_logging.LogRecord("test",20,"test.py",1,"file %d",(number,),None)
+            log_record.created=number*0.1
+            repeat_filter.filter(log_record)
+        self.assertLessEqual(len(repeat_filter._seen),200) #pylint: disable=protected-access
+
+    def test_repeat_filter_pruned_pending(self):
+        """Test suppressed repeats are still reported after the message was pruned
+        """
+        repeat_filter=RepeatFilter(10)
+        def record(created,msg="stall"):
+            log_record=real_logging.LogRecord("test",20,"test.py",1,msg,(),None)
+            log_record.created=created
+            return log_record
+        self.assertTrue(repeat_filter.filter(record(0)))
+        self.assertFalse(repeat_filter.filter(record(1)))
+        for number in range(100):
+            self.assertTrue(repeat_filter.filter(record(20+number,f"other {number}")))
+        repeated=record(200)
+        self.assertTrue(repeat_filter.filter(repeated))
+        self.assertEqual(repeated.getMessage(),"stall (1 repeats suppressed)")
+        self.assertLessEqual(len(repeat_filter._seen),20) #pylint: disable=protected-access
+
+    def test_config_logging_shared_filter(self):
+        """Test console and logfile handler output the same with suppressed repeats
+        """
+        logging=MagicMock()
+        root=real_logging.Logger("test_shared")
+        outputs=[[],[]]
+        for output in outputs:
+            handler=real_logging.Handler()
+            handler.emit=lambda record,output=output: output.append(record.getMessage())
+            root.addHandler(handler)
+        logging.getLogger=MagicMock(return_value=root)
+        configure_logging(False,logging,"test.log",10,repeat_interval=0.2)
+        child=real_logging.Logger("child")
+        child.parent=root
+        for _ in range(3):
+            child.warning("stall %d",1)
+        threading.Event().wait(0.25)
+        child.warning("stall %d",1)
+        self.assertEqual(outputs[0],outputs[1])
+        self.assertEqual(outputs[0],["stall 1","stall 1 (2 repeats suppressed)"])
+
+    def test_span_disabled(self):
+        """Test spans are not measured while disabled
+        """
+        enable_spans(False)
+        SPAN_TIMES.clear()
+        self.assertIs(span("test"),NULL_SPAN)
+        with span("test"):
+            pass
+        self.assertEqual(SPAN_TIMES,{})
+
+    def test_span_enabled(self):
+        """Test spans are counted and summarized
+        """
+        enable_spans()
+        try:
+            for _ in range(3):
+                with span("test"):
+                    pass
+        finally:
+            enable_spans(False)
+        self.assertEqual(SPAN_TIMES["test"][0],3)
+        self.assertIn("test",span_summary())
+
+    def test_run_profiled(self):
+        """Test both profilers write dump and summary
+        """
+        function=MagicMock(return_value=42)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for profile,suffix in (("cprofile",".prof"),("sample",".stacks")):
+                prefix=os.path.join(tmpdir,profile)
+                with mock.patch('builtins.print'):
+                    self.assertEqual(run_profiled(profile,prefix,function,1,key=2),42)
+                self.assertTrue(os.path.exists(prefix+suffix))
+                with open(prefix+".txt","r",encoding='utf-8') as summary:
+                    self.assertIn("span",summary.read())
+        function.assert_called_with(1,key=2)
+        self.assertIs(span("test"),NULL_SPAN)
+
+    def test_sampling_profiler(self):
+        """Test the stacks sampled are counted
+        """
+        profiler=SamplingProfiler()
+        frame=MagicMock()
+        frame.f_code.co_name="inner"
+        frame.f_code.co_filename="/path/module.py"
+        frame.f_code.co_firstlineno=10
+        frame.f_back.f_code.co_name="outer"
+        frame.f_back.f_code.co_filename="/path/module.py"
+        frame.f_back.f_code.co_firstlineno=1
+        frame.f_back.f_back=None
+        profiler._sample(0,frame) #pylint: disable=protected-access
+        profiler._sample(0,frame) #pylint: disable=protected-access
+        self.assertEqual(profiler.samples,{"outer (module.py:1);inner (module.py:10)":2})
+        self.assertIn("100.0% inner (module.py:10)",profiler.summary())
+
+    @mock.patch('tlu_utils.run_profiled')
+    @mock.patch('tlu_utils.argparse')
+    def test_execute_main_profiled(self,mock_arg,mock_profiled):
+        """Test cmdline_main runs the handler under the profiler
+        """
+        parser=MagicMock()
+        parser.parse_args=MagicMock(return_value=argparse.Namespace(profile="sample",
+                                                                   profile_out="out",arg1=1))
+        mock_arg.ArgumentParser=MagicMock(return_value=parser)
+        cmd=MagicMock()
+        cmdline_main(cmd)
+        mock_profiled.assert_called_once_with("sample","out",cmd.handle,arg1=1)
+        cmd.handle.assert_not_called()
+
+    @mock.patch('tlu_utils.run_profiled')
+    @mock.patch('tlu_utils.argparse')
+    def test_execute_main_profile_conflict(self,mock_arg,mock_profiled):
+        """Test cmdline_main refuses options the command can not be profiled with
+        """
+        parser=MagicMock()
+        parser.parse_args=MagicMock(return_value=argparse.Namespace(profile="sample",
+                                                                   profile_out=None,arg1=1))
+        parser.error=MagicMock(side_effect=SystemExit(2))
+        mock_arg.ArgumentParser=MagicMock(return_value=parser)
+        cmd=MagicMock()
+        cmd.profile_conflict=MagicMock(return_value="not with arg1")
+        self.assertRaises(SystemExit,cmdline_main,cmd)
+        cmd.profile_conflict.assert_called_once_with({"arg1":1})
+        parser.error.assert_called_once_with("not with arg1")
+        mock_profiled.assert_not_called()
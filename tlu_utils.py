@@ -14,16 +14,79 @@ Info
 Code
 ####
 """
+import io
+import os
+import sys
+import time
+import signal
 import argparse
-from subprocess import run
+import importlib
+from collections import Counter
+
+#: Version baked in at packaging time, eg. by git describe --tags --always > VERSION
+VERSION_FILE=os.path.join(os.path.dirname(os.path.abspath(__file__)),"VERSION")
+
+
+class LazyModule():
+    """Stands in for a module that is imported on first use only,
+    keeps the startup of the commandline apps fast
+
+    """
+    def __init__(self, name):
+        self._name=name
+        self._module=None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module=importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+def lazy_import(name):
+    """Import a module on first use
+
+    Args:
+        name (str): Name of the module, eg. serial
+
+    Returns:
+        LazyModule: Proxy to be used like the module
+    """
+    return LazyModule(name)
+
+def run(*args, **kwargs):
+    """subprocess.run, but subprocess is imported only when a process is started
+
+    Returns:
+        CompletedProcess: result of the process
+    """
+    import subprocess #pylint: disable=import-outside-toplevel
+    return subprocess.run(*args, **kwargs) #pylint: disable=subprocess-run-check
+
+def get_build_version():
+    '''
+    retrieve the version baked into the VERSION file at packaging time
+    :returns: Version as string or empty if there is no VERSION file
+    '''
+    try:
+        with open(VERSION_FILE,"r",encoding='utf-8') as version_file:
+            return version_file.read().strip()
+    except OSError:
+        return ""
 
 def get_git_version():
     '''
-    retrieve the current git provided version, based on the latest tag
+    retrieve the current version, from the build metadata if available, otherwise the
+    git provided version, based on the latest tag
     :returns: Version as string, eg. 0.1.0-97-g1d18af9 or empty in case of error
     '''
-    completed_process=run(['git','--no-pager', 'describe', '--tags', '--always'],
-            capture_output=True, check=False)
+    version=get_build_version()
+    if version:
+        return version
+    try:
+        completed_process=run(['git','--no-pager', 'describe', '--tags', '--always'],
+                capture_output=True, check=False)
+    except OSError:
+        return ""
     if completed_process.returncode != 0:
         return ""
     return completed_process.stdout.decode('utf-8')
@@ -41,6 +104,17 @@ def add_parser_log_args(parser,default_loglevel=20):
                         type=int, choices=[0,10,20,30,40,50], default=default_loglevel)
     parser.add_argument('--version', help="Returns current git version and terminates",
                         required=False, action='store_true')
+    parser.add_argument('--log_queue', help="Format and write log messages in a separate "\
+                        "thread", required=False, action='store_true')
+    parser.add_argument('--log_repeat_interval', help="Seconds an identical log message is "\
+                        "suppressed, 0 logs every repeat", type=float, default=0.0,
+                        required=False, action='store')
+    parser.add_argument('--profile', help="Run under cProfile or a sampling profiler and "\
+                        "time the hot sections", choices=['cprofile','sample'],
+                        required=False, default=None, action='store')
+    parser.add_argument('--profile_out', help="Path and prefix of the profile dump and "\
+                        "summary (.prof/.stacks and .txt)", required=False,
+                        default="cpm_profile", action='store')
 
 def cmdline_main(cmd):
     """Main function content for a commandline handling app
@@ -57,9 +131,105 @@ def cmdline_main(cmd):
     cmd_options = vars(options)
     # Move positional args out of options to mimic legacy optparse
     args = cmd_options.pop('args', ())
-    cmd.handle(*args,**cmd_options)
+    profile = cmd_options.pop('profile', None)
+    profile_out = cmd_options.pop('profile_out', None) or "cpm_profile"
+    if profile is None:
+        cmd.handle(*args,**cmd_options)
+    else:
+        #the command may refuse options its run can not be profiled with
+        error=cmd.profile_conflict(cmd_options) if hasattr(cmd,'profile_conflict') else None
+        if error:
+            parser.error(error)
+        run_profiled(profile,profile_out,cmd.handle,*args,**cmd_options)
+
+class RepeatFilter():
+    """Logging filter that lets an identical message (same text and arguments) pass
+    once per interval only, the number of suppressed repeats is added to the next one.
+    One instance is shared by all handlers, each record is decided once and the
+    decision is kept on the record, so every handler outputs the same.
+    """
+    def __init__(self, interval):
+        self.interval=interval
+        self._seen={}
+        self._pruned=0.0
+
+    def _prune(self, now):
+        #forget messages not seen for an interval, keeps the daemon from growing,
+        #messages with suppressed repeats are kept until their count is reported
+        if now-self._pruned<self.interval:
+            return
+        self._pruned=now
+        self._seen={key: last for key,last in self._seen.items()
+                    if now-last[2]<self.interval or last[1]}
+
+    def filter(self, record):
+        """Decide whether the record is logged
+
+        Args:
+            record (LogRecord): the record to be logged
+
+        Returns:
+            bool: True if the record should be logged
+        """
+        passed=getattr(record,"repeat_passed",None)
+        if passed is not None:
+            return passed
+        passed=self._decide(record)
+        record.repeat_passed=passed
+        return passed
+
+    def _decide(self, record):
+        now=record.created
+        try:
+            key=(record.name,record.levelno,record.msg,record.args)
+            last=self._seen.get(key)
+        except TypeError:
+            #unhashable arguments are never suppressed
+            return True
+        self._prune(now)
+        if last is not None and now-last[0]<self.interval:
+            last[1]+=1
+            last[2]=now
+            return False
+        if last is not None and last[1]:
+            record.msg=str(record.msg)+f" ({last[1]} repeats suppressed)"
+        self._seen[key]=[now,0,now]
+        return True
+
+
+def _start_queue_listener(logging, root):
+    """Move the handlers of the root logger behind a queue, they are served by a
+    listener thread, so formatting and file I/O do not block the logging thread
 
-def configure_logging(use_logfile,logging,log_file,log_level):
+    Args:
+        logging (Class): Logging class, not the Logger
+        root (Logger): the root logger
+
+    Returns:
+        QueueListener: the listener started, stopped at exit
+    """
+    handlers_module=importlib.import_module('logging.handlers')
+
+    class DeferredQueueHandler(handlers_module.QueueHandler):
+        """Queues the record as it is, the message is formatted by the listener"""
+        def prepare(self, record):
+            return record
+
+    handlers=list(root.handlers)
+    log_queue=importlib.import_module('queue').SimpleQueue()
+    listener=handlers_module.QueueListener(log_queue,*handlers,respect_handler_level=True)
+    queue_handler=DeferredQueueHandler(log_queue)
+    for handler in handlers:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    listener.start()
+    importlib.import_module('atexit').register(listener.stop)
+    logging.debug("Logging now via queue listener")
+    return listener
+
+
+def configure_logging(use_logfile,logging,log_file,log_level,use_queue=False,
+                      repeat_interval=0.0):
     """Configue logging for a logfile and console or console
 
     Args:
@@ -67,6 +237,11 @@ def configure_logging(use_logfile,logging,log_file,log_level):
         logging (Class): Logging class, not the Logger
         log_file (str): full path and logfilename
         log_level (int): log level the higher the more severe
+        use_queue (Bool): If true format and write the messages in a listener thread
+        repeat_interval (float): Seconds an identical message is suppressed, 0 = never
+
+    Returns:
+        QueueListener: the listener if use_queue is set, otherwise None
     """
     if use_logfile:
         #define filehandler first
@@ -88,4 +263,190 @@ def configure_logging(use_logfile,logging,log_file,log_level):
                             format='%(asctime)s;%(filename)-16.16s;%(lineno)04d;'+\
                             '%(levelname)-8s;%(message)s'
                             )
- 
\ No newline at end of file
+    root=logging.getLogger()
+    listener=None
+    if use_queue and not any(type(handler).__name__=="DeferredQueueHandler"
+                             for handler in root.handlers):
+        listener=_start_queue_listener(logging,root)
+    if repeat_interval>0:
+        #records of other loggers do not pass the filters of the root logger,
+        #so the handlers share one filter, in queue mode it is the queue handler only
+        repeat_filter=RepeatFilter(repeat_interval)
+        for handler in root.handlers:
+            handler.addFilter(repeat_filter)
+    return listener
+
+
+class _NullSpan():
+    """Span used while timing is disabled, does nothing"""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+#: Shared span returned while timing is disabled
+NULL_SPAN=_NullSpan()
+#: Timing of the named spans: name -> [count, seconds]
+SPAN_TIMES={}
+_spans_enabled=False #pylint: disable=invalid-name
+
+
+class _Span():
+    """Measures the time spent inside the with block"""
+    def __init__(self, name):
+        self.name=name
+        self.start=0.0
+
+    def __enter__(self):
+        self.start=time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        times=SPAN_TIMES.setdefault(self.name,[0,0.0])
+        times[0]+=1
+        times[1]+=time.perf_counter()-self.start
+        return False
+
+
+def span(name):
+    """Named timing span around a hot section, eg. with span("serial read"): ...
+    Costs only a function call while timing is disabled.
+
+    Args:
+        name (str): Name of the section
+
+    Returns:
+        context manager: measuring the time if enabled
+    """
+    if not _spans_enabled:
+        return NULL_SPAN
+    return _Span(name)
+
+def enable_spans(enabled=True):
+    """Switch the timing of the spans on or off, switching on resets the times
+
+    Args:
+        enabled (bool): True to measure the spans
+    """
+    global _spans_enabled #pylint: disable=global-statement,invalid-name
+    if enabled:
+        SPAN_TIMES.clear()
+    _spans_enabled=enabled
+
+def span_summary():
+    """Summary of the spans measured
+
+    Returns:
+        str: One line per span, sorted by total time
+    """
+    lines=[f"{'span':24s} {'count':>10s} {'total s':>10s} {'avg ms':>10s}"]
+    for name,(count,total) in sorted(SPAN_TIMES.items(),key=lambda item:-item[1][1]):
+        lines.append(f"{name:24s} {count:10d} {total:10.3f} {total*1000/count:10.3f}")
+    return "\n".join(lines)
+
+
+class SamplingProfiler():
+    """Low overhead profiler: a timer signal samples the stack of the main thread
+    in regular intervals, the stacks are counted
+    """
+    def __init__(self, interval=0.005):
+        self.interval=interval
+        self.samples=Counter()
+
+    def _sample(self, signum, frame): #pylint: disable=unused-argument
+        stack=[]
+        while frame is not None:
+            code=frame.f_code
+            stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:"\
+                f"{code.co_firstlineno})")
+            frame=frame.f_back
+        self.samples[";".join(reversed(stack))]+=1
+
+    def start(self):
+        """Start sampling
+        """
+        signal.signal(signal.SIGPROF,self._sample)
+        signal.setitimer(signal.ITIMER_PROF,self.interval,self.interval)
+
+    def stop(self):
+        """Stop sampling
+        """
+        signal.setitimer(signal.ITIMER_PROF,0,0)
+        signal.signal(signal.SIGPROF,signal.SIG_DFL)
+
+    def dump(self, filename):
+        """Write the stacks in the collapsed format used by flamegraph tools
+
+        Args:
+            filename (str): file to write to
+        """
+        with open(filename,"w",encoding='utf-8') as dump_file:
+            for stack,count in self.samples.most_common():
+                dump_file.write(f"{stack} {count}\n")
+
+    def summary(self, limit=20):
+        """Functions with the most samples on top of the stack
+
+        Args:
+            limit (int): Number of functions
+
+        Returns:
+            str: One line per function
+        """
+        total=sum(self.samples.values())
+        own=Counter()
+        for stack,count in self.samples.items():
+            own[stack.rsplit(";",1)[-1]]+=count
+        lines=[f"{total} samples every {self.interval*1000:.1f} ms"]
+        for function,count in own.most_common(limit):
+            lines.append(f"{count*100/total:6.1f}% {function}")
+        return "\n".join(lines)
+
+
+def run_profiled(profile, profile_out, function, *args, **kwargs):
+    """Run a function under a profiler with the timing spans enabled and write
+    the dump (<profile_out>.prof or .stacks) and a summary (<profile_out>.txt)
+
+    Args:
+        profile (str): cprofile or sample
+        profile_out (str): path and prefix of the files written
+        function (function): function to run, eg. cmd.handle
+
+    Returns:
+        any: result of the function
+    """
+    if profile=="sample" and not hasattr(signal,'setitimer'):
+        print("Sampling is not available on this platform, using cProfile",file=sys.stderr)
+        profile="cprofile"
+    if profile=="sample":
+        profiler=SamplingProfiler()
+        dump_file=profile_out+".stacks"
+    else:
+        #only needed for this profiler
+        import cProfile #pylint: disable=import-outside-toplevel
+        import pstats #pylint: disable=import-outside-toplevel
+        profiler=cProfile.Profile()
+        dump_file=profile_out+".prof"
+    enable_spans()
+    try:
+        if profile=="sample":
+            profiler.start()
+            try:
+                return function(*args,**kwargs)
+            finally:
+                profiler.stop()
+        return profiler.runcall(function,*args,**kwargs)
+    finally:
+        enable_spans(False)
+        if profile=="sample":
+            profiler.dump(dump_file)
+            summary=profiler.summary()
+        else:
+            profiler.dump_stats(dump_file)
+            stream=io.StringIO()
+            pstats.Stats(profiler,stream=stream).sort_stats('cumulative').print_stats(20)
+            summary=stream.getvalue()
+        with open(profile_out+".txt","w",encoding='utf-8') as summary_file:
+            summary_file.write(summary+"\n\n"+span_summary()+"\n")
+        print(f"Profile written to {dump_file}, summary to {profile_out}.txt",file=sys.stderr)